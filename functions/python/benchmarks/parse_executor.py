@@ -0,0 +1,93 @@
+"""
+Measures how fast course pages can be parsed on the event loop, in a thread pool, and in a process pool with different
+numbers of workers (see utils.get_parse_executor and COURSE_PAGE_PARSE_EXECUTOR in main.py)
+
+Usage (from functions/python, with the requirements installed):
+    python benchmarks/parse_executor.py [--pages N] [--assignments N] [--max-workers N]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+
+
+def generate_course_page(assignment_count: int) -> bytes:
+    """
+    Generates the assignments table of a course page with the given number of assignments (in the same form as
+    utils.read_page_section returns it)
+    """
+    rows = []
+    for i in range(assignment_count):
+        # Mix the different forms of row Gradescope uses
+        link = (f'<button data-assignment-id="{i}">Homework {i}</button>' if i % 2 else
+                f'<a href="/courses/1/assignments/{i}/submissions">Homework {i}</a>')
+        status = "Submitted" if i % 3 else "No Submission"
+        rows.append(f'<tr role="row"><th class="table--primaryLink">{link}</th>'
+                    f'<td><div>-</div><div>{status}</div></td>'
+                    f'<td><div class="progressBar"><span>Released</span><span>Due</span><div>'
+                    f'<time datetime="2026-10-01 10:00:00 -0400">Oct 01</time>'
+                    f'<time datetime="2026-10-{1 + i % 28:02} 23:59:00 -0400">Oct {1 + i % 28:02}</time>'
+                    f'</div></div></td></tr>')
+    return (f'<table class="table" id="assignments-student-table"><thead><tr><th>Name</th><th>Status</th>'
+            f'<th>Due</th></tr></thead><tbody>{"".join(rows)}</tbody></table>').encode()
+
+
+async def parse_pages(page: bytes, page_count: int, kind: str | None, workers: int | None) -> float:
+    """
+    Parses a page page_count times at once in the given kind of executor and returns the number of pages parsed per
+    second
+    """
+    executor = utils.get_parse_executor(kind, workers)
+    loop = asyncio.get_running_loop()
+    if executor is not None:
+        # Wait for the workers to start, so the time it takes isn't counted
+        await asyncio.gather(*(loop.run_in_executor(executor, utils.parse_course_assignments, page, "1")
+                               for _ in range(workers)))
+
+    start_time = time.perf_counter()
+    if executor is None:
+        for _ in range(page_count):
+            utils.parse_course_assignments(page, "1")
+    else:
+        await asyncio.gather(*(loop.run_in_executor(executor, utils.parse_course_assignments, page, "1")
+                               for _ in range(page_count)))
+    elapsed = time.perf_counter() - start_time
+
+    if executor is not None:
+        utils.discard_parse_executor(executor)
+    return page_count / elapsed
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=200, help="number of pages to parse in each run")
+    parser.add_argument("--assignments", type=int, default=50, help="number of assignments on each page")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count(), help="largest pool size to try")
+    args = parser.parse_args()
+
+    page = generate_course_page(args.assignments)
+    print(f"{args.pages} pages of {args.assignments} assignments ({len(page) // 1024} KiB each), "
+          f"{os.cpu_count()} CPUs")
+
+    baseline = await parse_pages(page, args.pages, None, None)
+    print(f"{'event loop':<20} {baseline:10.1f} pages/s")
+
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= args.max_workers:
+        worker_counts.append(worker_counts[-1] * 2)
+    if worker_counts[-1] != args.max_workers:
+        worker_counts.append(args.max_workers)
+
+    for kind in ("thread", "process"):
+        for workers in worker_counts:
+            throughput = await parse_pages(page, args.pages, kind, workers)
+            print(f"{f'{kind} x {workers}':<20} {throughput:10.1f} pages/s ({throughput / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,12 @@
 import asyncio
-from typing import Any, Optional
-
+import collections
+import dataclasses
+import functools
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, Optional
+
+import aiohttp
 from cryptography.fernet import Fernet
 
 from firebase_admin import db, initialize_app, functions
@@ -11,6 +17,7 @@ from firebase_functions.params import SecretParam
 from firebase_functions.options import RetryConfig, RateLimits
 
 from googleapiclient.discovery import build as build_google_api_service
+from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import Flow
 
 import utils
@@ -19,8 +26,82 @@ import utils
 app = initialize_app()
 
 # Settings
-# The number of users' calendars that can be updated in a single batch
-USER_AUTO_UPDATE_BATCH_SIZE = int(((10 * 60) / 3) / 2)  # 10 minutes before timeout / 3 seconds per user / half capacity
+# How often the scheduled update runs (This must match the schedule of update_calendars)
+USER_AUTO_UPDATE_INTERVAL = 60 * 60
+# Each scheduled update only updates the users which are due to be synced before the next one. Users are synced more
+# often when they have assignments due soon, or when their assignments have changed recently.
+USER_SYNC_INTERVALS = [  # (If the next assignment is due in less than, sync every) seconds
+    (24 * 60 * 60, 60 * 60),
+    (3 * 24 * 60 * 60, 3 * 60 * 60),
+    (7 * 24 * 60 * 60, 6 * 60 * 60),
+]
+USER_SYNC_MAX_INTERVAL = 24 * 60 * 60  # Seconds between syncs for users with no assignments due soon
+USER_SYNC_RECENT_CHANGE_WINDOW = 24 * 60 * 60  # Users whose assignments changed in this many seconds...
+USER_SYNC_RECENT_CHANGE_INTERVAL = 3 * 60 * 60  # ...are synced at least every this many seconds
+# The scheduled update's batches are started at different times over this many seconds, so that they don't all hit
+# Gradescope and Google at once (Each user always lands at about the same point in the window, based on their UID, and
+# the window ends early enough for the last batch to finish before the next scheduled update)
+USER_AUTO_UPDATE_SPREAD = USER_AUTO_UPDATE_INTERVAL - 10 * 60
+# The number of users whose sync states the scheduled update reads from the database at a time
+USER_AUTO_UPDATE_PAGE_SIZE = 1000
+# The maximum number of batch tasks to enqueue at the same time
+TASK_ENQUEUE_CONCURRENCY = 16
+# How long to reuse the looked up URL of the batch function for
+FUNCTION_URL_TTL = 60 * 60
+# Users are packed into batches based on how long they took to update in previous runs (The 95th percentile of their
+# most recent update times is used as their cost)
+USER_AUTO_UPDATE_DEFAULT_DURATION = 3  # Cost in seconds of users with no recorded update times
+USER_AUTO_UPDATE_DURATION_HISTORY = 20  # Number of update times to keep for each user
+USER_AUTO_UPDATE_BATCH_UTILIZATION = 0.5  # Fraction of each batch's time limit to fill, to leave room for slow runs
+USER_AUTO_UPDATE_MAX_BATCH_SIZE = 500  # Maximum number of users in a batch, regardless of their cost
+# The time limit for updating a batch (Once too little of this is left, no new users are started, and the rest of the
+# batch is passed on to a new task)
+USER_AUTO_UPDATE_DEADLINE = 10 * 60  # Seconds before the task times out
+USER_AUTO_UPDATE_START_MARGIN = 2 * 60  # Stop starting new users when there are fewer than this many seconds left
+USER_AUTO_UPDATE_FINISH_MARGIN = 30  # Cancel unfinished users when there are fewer than this many seconds left
+# The maximum number of users in a batch whose calendars can be updated at the same time
+# (This also sizes the thread pool which runs the blocking parts of each update)
+USER_AUTO_UPDATE_CONCURRENCY = 16
+# The Gradescope connection pool shared by all the users in a batch
+GRADESCOPE_CONNECTION_POOL_LIMIT = 32  # Maximum number of simultaneous connections
+GRADESCOPE_DNS_CACHE_TTL = 10 * 60  # Seconds to cache DNS lookups for
+GRADESCOPE_KEEPALIVE_TIMEOUT = 60  # Seconds to keep idle connections open for
+# Where the batch parses Gradescope course pages: None to parse them on the event loop, "thread" to parse them in a
+# thread pool (lxml releases the GIL while it parses), or "process" to parse them in a pool of worker processes
+# (This is worth turning on when instances have more than one CPU, see benchmarks/parse_executor.py)
+COURSE_PAGE_PARSE_EXECUTOR = None
+COURSE_PAGE_PARSE_WORKERS = None  # Number of parse workers (None to use one per CPU)
+# The total number of requests per second all batches can make to Gradescope (Each running batch gets an even share of
+# this, and adapts its rate within that share based on how Gradescope responds, see utils.AdaptiveRateLimiter)
+# The budget stored at GRADESCOPE_REQUEST_BUDGET_PATH in the database overrides this, so it can be changed live
+GRADESCOPE_REQUEST_BUDGET = 50
+GRADESCOPE_REQUEST_BUDGET_PATH = "rate_limits/gradescope"
+# The database writes made while updating a batch are collected and sent together
+DATABASE_WRITE_BUFFER_SIZE = 500  # Number of paths to collect before sending them
+# Maximum number of seconds a write can wait to be sent (Each user's sync lease is held until their writes are sent,
+# so this should be well under SYNC_LEASE_WAIT)
+DATABASE_WRITE_BUFFER_DELAY = 10
+# How long a successful check of a user's Gradescope token is trusted before the token is checked again
+GRADESCOPE_TOKEN_VALIDATION_TTL = 24 * 60 * 60
+# If enabled, Gradescope tokens are never checked up front. Instead, the user is logged in again if Gradescope rejects
+# the token while their courses are being fetched.
+GRADESCOPE_OPTIMISTIC_TOKEN_VALIDATION = True
+# How long a successful check that a user's calendar exists and is writable is trusted before it is checked again
+# (The check is also redone if the calendar rejects an event update)
+CALENDAR_VALIDATION_TTL = 24 * 60 * 60
+# The maximum number of batches of Google Calendar requests that can be sent for a single user at the same time
+CALENDAR_BATCH_CONCURRENCY = 4
+# The maximum number of times to retry a Google Calendar request which failed with a transient error
+CALENDAR_BATCH_MAX_RETRIES = 5
+# The number of events to list at a time when reconciling a calendar with the assignment cache (the most Google allows)
+# (Only the first reconciliation of each calendar lists every event, later ones only list the events which changed)
+CALENDAR_SYNC_PAGE_SIZE = 2500
+# Each user is only synced by one function at a time (see utils.acquire_sync_lease)
+SYNC_LEASE_DURATION = 5 * 60  # Seconds before a manual refresh's lease expires if it is never released
+SYNC_LEASE_WAIT = 30  # Seconds a manual refresh waits for a sync which is already running before giving up
+# Users whose scheduled sync fails are retried in a new task, with the delay doubling after each failure
+SYNC_RETRY_BASE_DELAY = 5 * 60  # Seconds before the first retry
+SYNC_RETRY_MAX_ATTEMPTS = 4  # Number of failures in a row before giving up until the next scheduled sync
 
 debug = False
 if debug:
@@ -52,13 +133,29 @@ def get_fernet() -> Fernet:
     return Fernet(DATA_ENCRYPTION_SECRET.value)
 
 
-def login_to_google(uid: str, fernet: Fernet) -> Any:
+def get_gradescope_token(user: utils.UserContext, fernet: Fernet) -> str | None:
+    """
+    Gets the user's Gradescope token, only validating it as often as the token validation settings require.
+    """
+    return utils.get_gradescope_token(user, fernet, GRADESCOPE_TOKEN_VALIDATION_TTL,
+                                      GRADESCOPE_OPTIMISTIC_TOKEN_VALIDATION)
+
+
+def login_to_google(user: utils.UserContext, fernet: Fernet) -> Any:
     """
     Logs the user in to Google and returns the credentials or returns the debug token if debug mode is enabled.
     """
     if debug:
         return debug_config["google_api_token"]
-    return utils.login_to_google(uid, OAUTH2_CLIENT_ID, OAUTH2_CLIENT_SECRET, fernet)
+    return utils.login_to_google(user, OAUTH2_CLIENT_ID, OAUTH2_CLIENT_SECRET, fernet)
+
+
+async def build_calendar_service(user: utils.UserContext, fernet: Fernet) -> Any:
+    """
+    Logs the user in to Google and connects to the Google Calendar API without blocking the event loop.
+    """
+    credentials = await utils.run_blocking(login_to_google, user, fernet)
+    return await utils.run_blocking(build_google_api_service, 'calendar', 'v3', credentials=credentials)
 
 
 def secrets(*secret_objs: Optional[SecretParam]) -> Optional[list[SecretParam]]:
@@ -103,8 +200,12 @@ def oauth_callback(request: https_fn.CallableRequest) -> utils.CallableFunctionR
         return utils.fn_response({"success": False}, FunctionsErrorCode.INVALID_ARGUMENT)
 
     # Store the refresh token in the database
-    db.reference(f'credentials/{uid}/google/token').set(
-        utils.fernet_encrypt(flow.credentials.refresh_token, get_fernet()))
+    # (Cache the access token that came with it too, replacing any token which was issued for a previous link)
+    fernet = get_fernet()
+    db.reference(f'credentials/{uid}/google').set({
+        "token": utils.fernet_encrypt(flow.credentials.refresh_token, fernet),
+        "access_token": utils.encrypt_google_access_token(flow.credentials, fernet) if flow.credentials.expiry else None
+    })
     db.reference(f'auth_status/{uid}/google').set(True)
 
     return utils.fn_response({"success": True})
@@ -123,10 +224,17 @@ def update_gradescope_token(req: https_fn.CallableRequest) -> utils.CallableFunc
 
     if "token" in req.data:  # If the request has a token parameter, we're authenticating by token
 
-        if utils.check_gradescope_token(req.data["token"]):  # If the token is valid
+        try:
+            token_valid = utils.check_gradescope_token(req.data["token"])
+        except utils.SERVICE_OUTAGE_ERRORS as e:
+            print(f"Could not check a Gradescope token: {e}")
+            return utils.fn_response("gradescope_unavailable", FunctionsErrorCode.UNAVAILABLE)
+
+        if token_valid:  # If the token is valid
             # Store it in the database
             gradescope_credentials = {
                 "token": utils.fernet_encrypt(req.data["token"], get_fernet()),
+                "validated_at": time.time(),
                 # While we're at it, delete the email and password from the database (if they exist)
                 "email": None,
                 "password": None
@@ -143,7 +251,11 @@ def update_gradescope_token(req: https_fn.CallableRequest) -> utils.CallableFunc
         return utils.fn_response("invalid_gradescope_auth", FunctionsErrorCode.INVALID_ARGUMENT)
 
     # Try to log in to Gradescope with the given email and password
-    token = utils.login_to_gradescope(req.data["email"], req.data["password"])
+    try:
+        token = utils.login_to_gradescope(req.data["email"], req.data["password"])
+    except utils.SERVICE_OUTAGE_ERRORS as e:
+        print(f"Could not log in to Gradescope: {e}")
+        return utils.fn_response("gradescope_unavailable", FunctionsErrorCode.UNAVAILABLE)
     if not token:
         return utils.fn_response("invalid_gradescope_auth", FunctionsErrorCode.INVALID_ARGUMENT)
 
@@ -152,6 +264,7 @@ def update_gradescope_token(req: https_fn.CallableRequest) -> utils.CallableFunc
     store_credentials = req.data.get("store-credentials", False)
     gradescope_credentials = {
         "token": utils.fernet_encrypt(token, fernet),
+        "validated_at": time.time(),
         # If the user wants to store their credentials, store them, otherwise delete them (if they exist)
         "email": utils.fernet_encrypt(req.data["email"], fernet) if store_credentials else None,
         "password": utils.fernet_encrypt(req.data["password"], fernet) if store_credentials else None
@@ -199,11 +312,27 @@ def refresh_course_list(req: https_fn.CallableRequest) -> utils.CallableFunction
         return utils.fn_response({"success": False}, FunctionsErrorCode.UNAUTHENTICATED)
     uid = req.auth.uid
 
-    # Check that the user has a valid Gradescope token
-    if not (gradescope_token := utils.get_gradescope_token(uid, get_fernet())):
-        return utils.fn_response("invalid_gradescope_auth", FunctionsErrorCode.PERMISSION_DENIED)
-
     # Get the user's courses from Gradescope
+    user = utils.UserContext(uid)
+    fernet = get_fernet()
+    # HTML parsing nonsense
+    course_list_query = ".//div[@class='courseList']/div[@class='courseList--coursesForTerm'][2]/a[@class='courseBox ']"
+    try:
+        # Check that the user has a valid Gradescope token
+        if not (gradescope_token := get_gradescope_token(user, fernet)):
+            return utils.fn_response("invalid_gradescope_auth", FunctionsErrorCode.PERMISSION_DENIED)
+
+        try:
+            course_elements = utils.get_data_from_gradescope("", course_list_query, gradescope_token)
+        except utils.GradescopeAuthError:
+            # The token may not have been validated before it was used, so try logging in again before giving up
+            if not (gradescope_token := utils.refresh_gradescope_token(user, fernet)):
+                return utils.fn_response("invalid_gradescope_auth", FunctionsErrorCode.PERMISSION_DENIED)
+            course_elements = utils.get_data_from_gradescope("", course_list_query, gradescope_token)
+    except utils.SERVICE_OUTAGE_ERRORS as e:
+        print(f"Could not refresh the course list of {uid}: {e}")
+        return utils.fn_response("gradescope_unavailable", FunctionsErrorCode.UNAVAILABLE)
+
     gradescope_courses = [
         {
             "name": utils.transform_or_default(course.find("./h3"), lambda course_name: course_name.text,
@@ -211,11 +340,7 @@ def refresh_course_list(req: https_fn.CallableRequest) -> utils.CallableFunction
             # The href is relative to the Gradescope domain (https://www.gradescope.com/<href>)
             "href": course.attrib["href"]
         }
-        for course in utils.get_data_from_gradescope("",
-                                                     # HTML parsing nonsense
-                                                     ".//div[@class='courseList']/div["
-                                                     "@class='courseList--coursesForTerm'][2]/a[@class='courseBox ']",
-                                                     gradescope_token)
+        for course in course_elements
     ]
     # Map each course's ID to the course object
     gradescope_courses = {
@@ -250,61 +375,180 @@ async def refresh_events(req: https_fn.CallableRequest) -> utils.CallableFunctio
         return utils.fn_response({"success": False}, FunctionsErrorCode.UNAUTHENTICATED)
     uid = req.auth.uid
 
+    # Make sure that the user isn't already being synced (by the scheduled update or an earlier click)
+    lease_id, generation = await utils.run_blocking(utils.acquire_sync_lease, uid, SYNC_LEASE_DURATION)
+    if lease_id is None:
+        # If they are, wait for that sync and reuse its result
+        if await utils.wait_for_sync_lease(uid, generation, SYNC_LEASE_WAIT):
+            return utils.fn_response({"success": True})
+        # If it didn't finish, try to take over
+        lease_id, _ = await utils.run_blocking(utils.acquire_sync_lease, uid, SYNC_LEASE_DURATION)
+        if lease_id is None:
+            return utils.fn_response("sync_in_progress", FunctionsErrorCode.ABORTED)
+
+    synced = False
+    try:
+        response = await refresh_events_for_user(uid)
+        synced = True
+        return response
+    except utils.SERVICE_OUTAGE_ERRORS as e:
+        # Gradescope or Google is down, so the user should try again later
+        print(f"Could not refresh the events of {uid}: {e}")
+        return utils.fn_response("service_unavailable", FunctionsErrorCode.UNAVAILABLE)
+    finally:
+        # (Only a successful sync counts, so that the callers waiting for it don't report a failed sync as a success)
+        await utils.run_blocking(utils.release_sync_lease, uid, lease_id, synced=synced)
+
+
+async def refresh_events_for_user(uid: str) -> utils.CallableFunctionResponse:
+    """
+    Updates a user's assignment cache and calendar for refresh_events (while holding the user's sync lease).
+    """
+    # Read all the user's data up front
+    user = (await utils.prefetch_user_contexts([uid]))[uid]
+
     # Check that the user has valid settings and a valid Gradescope token
-    if not (user_settings := utils.get_user_settings(uid)):
+    if not (user_settings := utils.get_user_settings(user)):
         return utils.fn_response("invalid_user_settings", FunctionsErrorCode.FAILED_PRECONDITION)
 
     fernet = get_fernet()
 
     # Validating the Gradescope token is more expensive, so we do it last
-    if not (gradescope_token := utils.get_gradescope_token(uid, fernet)):
+    if not (gradescope_token := await utils.run_blocking(get_gradescope_token, user, fernet)):
         return utils.fn_response("invalid_gradescope_auth", FunctionsErrorCode.PERMISSION_DENIED)
 
     # Connect to the Google Calendar API
-    with build_google_api_service('calendar', 'v3', credentials=login_to_google(uid, fernet)
-                                  ) as calendar_service:
+    with await build_calendar_service(user, fernet) as calendar_service:
 
         # Validate the user's calendar ID
-        if not utils.validate_calendar_id(user_settings["calendar_id"], calendar_service):
-            db.reference(f'settings/{uid}/calendar_id').delete()
+        if not await utils.run_blocking(utils.validate_calendar_id_with_cache, user, user_settings["calendar_id"],
+                                        calendar_service, CALENDAR_VALIDATION_TTL):
+            await utils.run_blocking(user.write, {f'settings/{uid}/calendar_id': None})
             return utils.fn_response("invalid_calendar_selection", FunctionsErrorCode.FAILED_PRECONDITION)
 
         # Update the user's assignment cache and use the updated cache to update the user's calendar
-        assignment_cache = await get_updated_assignment_cache(uid, user_settings, gradescope_token)
+        stored_assignment_cache = user.assignments
+        updated_cache = await get_updated_assignment_cache(user, user_settings, gradescope_token, fernet,
+                                                           utils.AssignmentCache(stored_assignment_cache))
+        if updated_cache is None:
+            return utils.fn_response("invalid_gradescope_auth", FunctionsErrorCode.PERMISSION_DENIED)
+        assignment_cache, course_fingerprints = updated_cache
 
-        await update_calendar_from_cache(uid, calendar_service, user_settings, assignment_cache)
+        await update_calendar_from_cache(user, calendar_service, user_settings, stored_assignment_cache,
+                                         assignment_cache)
+
+        # Only remember which course pages have been parsed once the assignments from them have been saved
+        user.cache["course_fingerprints"] = course_fingerprints
+        await utils.run_blocking(user.write, {f'cache/{uid}/course_fingerprints': course_fingerprints})
 
     return utils.fn_response({"success": True})
 
 
-# Run 4 times a day (every 6 hours) on the hour
-@scheduler_fn.on_schedule(schedule="0 */6 * * *",
+# Run every hour on the hour (see USER_AUTO_UPDATE_INTERVAL)
+# (The batches are spread out over the time until the next run, see USER_AUTO_UPDATE_SPREAD)
+@scheduler_fn.on_schedule(schedule="0 * * * *",
                           secrets=secrets(OAUTH2_CLIENT_ID, OAUTH2_CLIENT_SECRET, DATA_ENCRYPTION_SECRET))
 @utils.sync
 async def update_calendars(_event: scheduler_fn.ScheduledEvent) -> None:
     """
     This function is called by the periodically to push updates from the assignment cache to users' calendars.
+    Only the users which are due to be synced before the next run are updated (see schedule_next_sync).
     """
-    # Get all users (Iterate over the "credentials" key because "assignments" and "auth_status" might be blank and
-    #                "settings" is public facing)
-    users = utils.get_db_ref_as_type("credentials", dict, shallow=True)
-    if not users:
-        return
-    users = list(users.keys())
-
-    # Break the userbase into manageable batches
-    user_batches = [users[i:i + USER_AUTO_UPDATE_BATCH_SIZE] for i in range(0, len(users), USER_AUTO_UPDATE_BATCH_SIZE)]
+    # Break the due users into batches which should each take about the same amount of time
+    # (A batch updates up to USER_AUTO_UPDATE_CONCURRENCY users at a time, so its time budget is multiplied by that)
+    batch_budget = ((USER_AUTO_UPDATE_DEADLINE - USER_AUTO_UPDATE_START_MARGIN) * USER_AUTO_UPDATE_CONCURRENCY *
+                    USER_AUTO_UPDATE_BATCH_UTILIZATION)
+    user_batches = utils.pack_batches(list_due_users(), batch_budget, USER_AUTO_UPDATE_MAX_BATCH_SIZE)
 
-    # Create a task for each batch
-    queue = functions.task_queue("updateCalendarBatch")
-    function_url = utils.get_function_url("updateCalendarBatch")
+    # Create a task for each batch as soon as it is full, starting when its first user's slot in the window comes up
+    # (Since the users are in key order, this staggers the batches evenly over the window)
+    await enqueue_calendar_batches(user_batches, USER_AUTO_UPDATE_SPREAD)
 
-    options = TaskOptions(schedule_delay_seconds=1,         # Schedule the task to run 1 second after the current time
-                          dispatch_deadline_seconds=10*60,  # Set a 10-minute deadline for the task
-                          uri=function_url)
 
-    for batch in user_batches:
-        queue.enqueue({"data": {"users": batch}}, options)
+def list_due_users() -> Iterator[tuple[str, float]]:
+    """
+    Lists the users which are due to be synced before the next scheduled update (see schedule_next_sync), along with
+    how long each of them is expected to take to update. The users are listed in the same order as the database, and
+    their sync states are read one page at a time, so that each batch covers a contiguous range of keys, which its data
+    can be prefetched with.
+    """
+    next_run_time = time.time() + USER_AUTO_UPDATE_INTERVAL
+
+    # Iterate over the "credentials" key because "assignments" and "auth_status" might be blank and "settings" is
+    # public facing
+    # (Only the keys are read, since the credentials themselves are much larger than the sync states)
+    uids = sorted(utils.get_db_ref_as_type("credentials", dict, shallow=True) or {}, key=utils.db_key_order)
+    for page_start in range(0, len(uids), USER_AUTO_UPDATE_PAGE_SIZE):
+        users = uids[page_start:page_start + USER_AUTO_UPDATE_PAGE_SIZE]
+        sync_state = utils.get_db_key_range("sync_state", users[0], users[-1])
+        for uid in users:
+            user_sync_state = sync_state.get(uid, None) or {}
+            # Users which have never been synced are always due
+            if user_sync_state.get("next_sync_at", 0) < next_run_time:
+                yield uid, user_sync_state.get("duration_p95", USER_AUTO_UPDATE_DEFAULT_DURATION)
+
+
+async def enqueue_calendar_batches(user_batches: Iterable[list[str]], spread: float = 0, delay: float = 0) -> None:
+    """
+    Creates an updateCalendarBatch task for each batch of users, several at a time (see TASK_ENQUEUE_CONCURRENCY), and
+    prints a summary of how long it took and which batches could not be enqueued.
+
+    Args:
+        user_batches: The UIDs of the users in each batch (This can be a generator, in which case each task is created
+                      as soon as its batch is generated)
+        spread: The length of the window to stagger the batches over, in seconds (Each batch starts at its first user's
+                slot in the window (see utils.db_key_fraction). By default, each batch starts immediately.)
+        delay: The number of seconds to wait before the window starts
+    """
+    queue = functions.task_queue("updateCalendarBatch")
+    function_url = await utils.run_blocking(utils.get_function_url, "updateCalendarBatch", ttl=FUNCTION_URL_TTL)
+
+    semaphore = asyncio.Semaphore(TASK_ENQUEUE_CONCURRENCY)
+    latencies = []
+    failed_batches = []
+
+    # Each enqueue blocks a thread while it waits for Cloud Tasks, so give them their own threads
+    # (The default executor has too few threads to run TASK_ENQUEUE_CONCURRENCY of them at a time)
+    enqueue_executor = ThreadPoolExecutor(max_workers=TASK_ENQUEUE_CONCURRENCY, thread_name_prefix="enqueue")
+
+    async def enqueue_batch(batch: list[str]) -> None:
+        batch_delay = int(delay + utils.db_key_fraction(batch[0]) * spread)
+        options = TaskOptions(schedule_delay_seconds=max(batch_delay, 1),  # Always wait at least 1 second
+                              dispatch_deadline_seconds=USER_AUTO_UPDATE_DEADLINE,
+                              uri=function_url)
+        start_time = time.monotonic()
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                enqueue_executor, functools.partial(queue.enqueue, {"data": {"users": batch}}, options))
+            latencies.append(time.monotonic() - start_time)
+        except Exception as e:
+            print(f"Failed to enqueue the batch of {len(batch)} users starting at {batch[0]}: {e}")
+            failed_batches.append(batch)
+        finally:
+            semaphore.release()
+
+    # Wait for a free slot before generating each batch, so that only a bounded number of batches are held at a time
+    # (The batches are generated in the executor, since generating them may read from the database)
+    tasks = []
+    batch_iterator = iter(user_batches)
+    try:
+        while True:
+            await semaphore.acquire()
+            if (batch := await utils.run_blocking(next, batch_iterator, None)) is None:
+                semaphore.release()
+                break
+            tasks.append(asyncio.create_task(enqueue_batch(batch)))
+    finally:
+        # Even if generating the batches fails, finish enqueuing the batches which were generated and report on them
+        await asyncio.gather(*tasks)
+        enqueue_executor.shutdown()
+
+        if latencies:
+            print(f"Enqueued {len(latencies)} batches (latency: mean {sum(latencies) / len(latencies):.3f}s, "
+                  f"p95 {utils.percentile(latencies, 0.95):.3f}s, max {max(latencies):.3f}s)")
+        if failed_batches:
+            print(f"Failed to enqueue {len(failed_batches)} batches "
+                  f"({sum(len(batch) for batch in failed_batches)} users)")
 
 
 # noinspection PyPep8Naming
@@ -317,135 +561,550 @@ async def update_calendars(_event: scheduler_fn.ScheduledEvent) -> None:
 async def updateCalendarBatch(request: tasks_fn.CallableRequest) -> None:
     """
     This function is called asynchronously by update_calendars to update the cache and calendar for a group users.
+    If the batch can't be finished before the task times out, the users which weren't updated are passed on to a new
+    task.
     """
-    # Update the calendar for each user in the request asynchronously
-    tasks = [update_event_cache_and_calendar_for_user(uid) for uid in request.data["users"]]
-    await asyncio.gather(*tasks)
+    start_time = time.monotonic()
+    concurrency = request.data.get("concurrency", USER_AUTO_UPDATE_CONCURRENCY)
+    stats_before = utils.stats.copy()
+
+    # Most of the work for each user is blocking I/O (database reads, token checks, Google API calls), which runs in a
+    # thread pool. Size the pool to match the concurrency limit, so that the users in the batch actually overlap.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+
+    # Read the data for every user in the batch up front, rather than user by user
+    # (and collect their writes, so they can also be sent together)
+    write_buffer = utils.DatabaseWriteBuffer(DATABASE_WRITE_BUFFER_SIZE, DATABASE_WRITE_BUFFER_DELAY)
+    users = await utils.prefetch_user_contexts(request.data["users"], write_buffer)
+
+    # Share one pool of warm Gradescope connections between all the users in the batch
+    # (and limit the rate of requests to Gradescope to this instance's share of the budget for all batches)
+    gradescope_connector = utils.create_gradescope_connector(limit=GRADESCOPE_CONNECTION_POOL_LIMIT,
+                                                             dns_cache_ttl=GRADESCOPE_DNS_CACHE_TTL,
+                                                             keepalive_timeout=GRADESCOPE_KEEPALIVE_TIMEOUT)
+    async with gradescope_connector, \
+            utils.get_gradescope_rate_limiter().share_budget(GRADESCOPE_REQUEST_BUDGET_PATH, GRADESCOPE_REQUEST_BUDGET):
+        # Each user's sync lease is held until their writes have been saved (see refresh_events)
+        # The leases of the users which have finished, and whether each of them was synced, waiting for the next flush
+        finished_leases = {}
+
+        # The users which failed to sync, and how many times in a row they have failed (see record_sync_outcome)
+        failed_users = {}
+
+        async def update_user(user: utils.UserContext) -> None:
+            lease_duration = start_time + USER_AUTO_UPDATE_DEADLINE - time.monotonic()
+            try:
+                lease_id, generation = await utils.run_blocking(utils.acquire_sync_lease, user.uid, lease_duration)
+            except Exception as e:
+                utils.report_exception(e)
+                failed_users[user.uid] = record_sync_outcome(user, e)
+                return
+            if lease_id is None:
+                # Someone else is already syncing the user
+                return
+            if generation != user.sync_state.get("lease", {}).get("generation", 0):
+                # Someone else synced the user after their data was prefetched (so it is out of date, but they don't
+                # need to be synced again)
+                await utils.run_blocking(utils.release_sync_lease, user.uid, lease_id, synced=False)
+                return
+            synced = False
+            try:
+                if (attempts := await update_event_cache_and_calendar_for_user(user, gradescope_connector)) > 0:
+                    failed_users[user.uid] = attempts
+                else:
+                    synced = True
+            finally:
+                # (Users which failed or ran out of time are released without marking them as synced)
+                finished_leases[user.uid] = (lease_id, synced)
+
+        # The users whose writes could not be saved
+        unsaved_users = set()
+        flush_lock = asyncio.Lock()
+
+        async def flush_writes() -> None:
+            # Flushing blocks, so it is done in the executor (and never by the users' writes themselves)
+            async with flush_lock:
+                # The writes of the users which have already finished are all in this flush
+                flushed_leases = finished_leases.copy()
+                finished_leases.clear()
+                for uid in await utils.run_blocking(write_buffer.flush):
+                    if uid in users and uid not in unsaved_users:
+                        unsaved_users.add(uid)
+                        # Retry the user, since their sync wasn't saved
+                        failed_users[uid] = record_sync_outcome(users[uid], RuntimeError("Failed to save the sync"))
+                # Now that their writes have been saved, the finished users can be synced by someone else
+                await asyncio.gather(*(utils.run_blocking(utils.release_sync_lease, uid, lease_id,
+                                                          synced=synced and uid not in unsaved_users)
+                                       for uid, (lease_id, synced) in flushed_leases.items()))
+
+        async def flush_writes_when_due() -> None:
+            while True:
+                await asyncio.sleep(1)
+                if write_buffer.is_due():
+                    # (An error must not stop the periodic flushes, since the finished users' leases wait for them)
+                    try:
+                        await flush_writes()
+                    except Exception as e:
+                        utils.report_exception(e)
+
+        # Update the calendar for each user in the request asynchronously, until the task starts to run out of time
+        flusher = asyncio.create_task(flush_writes_when_due())
+        try:
+            unfinished_users = await utils.gather_until_deadline(
+                concurrency, list(users.values()), update_user,
+                start_deadline=start_time + USER_AUTO_UPDATE_DEADLINE - USER_AUTO_UPDATE_START_MARGIN,
+                finish_deadline=start_time + USER_AUTO_UPDATE_DEADLINE - USER_AUTO_UPDATE_FINISH_MARGIN)
+        finally:
+            flusher.cancel()
+            await flush_writes()
+            # (The retries recorded for users whose writes failed are also saved, if they can be)
+            await flush_writes()
+
+    print(f"Batch stats: {dict(utils.stats - stats_before)}")
+
+    if unfinished_users:
+        if len(unfinished_users) == len(users):
+            # If no one could be updated in the time limit, passing the batch on would just repeat this forever
+            # (These users will be updated again on the next scheduled run)
+            print(f"Could not update any of the {len(users)} users in the batch before the deadline")
+            return
+
+        print(f"Passing {len(unfinished_users)} users which were not updated before the deadline on to a new task")
+        await enqueue_calendar_batches([[user.uid for user in unfinished_users]])
 
+    await retry_failed_users(failed_users)
 
-async def update_event_cache_and_calendar_for_user(uid) -> None:
+
+async def retry_failed_users(failed_users: dict[str, int]) -> None:
     """
-    Updates the assignment cache and calendar for a single user.
+    Re-enqueues users whose sync failed, waiting exponentially longer the more times in a row they have failed, and
+    giving up after SYNC_RETRY_MAX_ATTEMPTS failures (until the next scheduled update).
+
+    Args:
+        failed_users: The UIDs of the users to retry, and how many times in a row each of them has failed
     """
-    await update_event_cache_for_user(uid)
-    await update_calendar_for_user(uid)
+    # Users which have failed the same number of times are retried together
+    retries = collections.defaultdict(list)
+    for uid, attempts in failed_users.items():
+        if attempts <= SYNC_RETRY_MAX_ATTEMPTS:
+            retries[attempts].append(uid)
+        else:
+            print(f"Giving up on retrying {uid} after {attempts} failed syncs")
 
+    for attempts, uids in retries.items():
+        delay = SYNC_RETRY_BASE_DELAY * 2 ** (attempts - 1)
+        print(f"Retrying {len(uids)} users which failed to sync in {delay} seconds (attempt {attempts})")
+        await enqueue_calendar_batches([sorted(uids, key=utils.db_key_order)], delay=delay)
 
-@utils.wrap_async_exceptions
-async def update_event_cache_for_user(uid) -> None:
+
+async def update_event_cache_and_calendar_for_user(user: utils.UserContext,
+                                                   gradescope_connector: aiohttp.BaseConnector) -> int:
     """
-    Updates the assignment cache for a single user and stores the updated cache in the database.
+    Updates the assignment cache and calendar for a single user, and records how long it took (see update_calendars)
+    and whether it succeeded (see record_sync_outcome).
+
+    Returns:
+        The number of times in a row the user has failed to sync (0 if the sync succeeded)
     """
-    # Check that the user has valid settings and a valid Gradescope token
-    if ((gradescope_token := utils.get_gradescope_token(uid, get_fernet())) and
-            (user_settings := utils.get_user_settings(uid))):
-        # Update the user's assignment cache
-        assignment_cache = await get_updated_assignment_cache(uid, user_settings, gradescope_token)
+    start_time = time.monotonic()
+    try:
+        error = None
+        try:
+            await update_event_cache_for_user(user, gradescope_connector)
+        except utils.CircuitOpenError as e:
+            # Gradescope is down, so this stage was skipped (This isn't worth reporting for every user)
+            # The calendar can still be updated from the stored cache
+            error = e
+        except Exception as e:
+            # The calendar can still be updated from the stored cache
+            utils.report_exception(e)
+            error = e
+        try:
+            await update_calendar_for_user(user)
+        except utils.CircuitOpenError as e:
+            error = e
+        except Exception as e:
+            utils.report_exception(e)
+            error = e
+
+        if error is None:
+            schedule_next_sync(user)
+        return record_sync_outcome(user, error)
+    finally:
+        # Also record the time for users which were cancelled for running out of time, since they are the ones which
+        # most need smaller batches (This doesn't wait for the executor, so that it can't be cancelled again)
+        record_user_update_duration(user, time.monotonic() - start_time)
+
+
+def record_sync_outcome(user: utils.UserContext, error: Optional[Exception] = None) -> int:
+    """
+    Records whether a user's sync succeeded, along with the error which it failed with, if it didn't.
 
-        # Store the updated cache in the database
-        db.reference(f'assignments/{uid}').set(assignment_cache)
+    Returns:
+        The number of times in a row the user has failed to sync (0 if the sync succeeded)
+    """
+    if error is None:
+        if user.sync_state.pop("retry", None) is not None:
+            user.write({f'sync_state/{user.uid}/retry': None})
+        return 0
+
+    attempts = (user.sync_state.get("retry", None) or {}).get("attempts", 0) + 1
+    user.sync_state["retry"] = {
+        "attempts": attempts,
+        "last_error": str(error)[:500] or type(error).__name__,
+        "failed_at": time.time()
+    }
+    user.write({f'sync_state/{user.uid}/retry': user.sync_state["retry"]})
+    return attempts
+
+
+def schedule_next_sync(user: utils.UserContext) -> None:
+    """
+    Decides when a user should next be synced by the scheduled update, based on how soon their next assignment is due
+    and how recently their assignments changed (see USER_SYNC_INTERVALS).
+    """
+    now = time.time()
+    interval = USER_SYNC_MAX_INTERVAL
+
+    if (next_due_date := utils.get_next_due_date(user.assignments)) is not None:
+        time_until_due = next_due_date.timestamp() - now
+        interval = next((sync_interval for due_within, sync_interval in USER_SYNC_INTERVALS
+                         if time_until_due < due_within), interval)
+
+    if now - user.sync_state.get("last_changed_at", 0) < USER_SYNC_RECENT_CHANGE_WINDOW:
+        interval = min(interval, USER_SYNC_RECENT_CHANGE_INTERVAL)
+
+    user.sync_state["next_sync_at"] = now + interval
+    user.write({f'sync_state/{user.uid}/next_sync_at': user.sync_state["next_sync_at"]})
+
+
+def record_user_update_duration(user: utils.UserContext, duration: float) -> None:
+    """
+    Adds an update time to a user's recent update times and updates their 95th percentile update time.
+    """
+    # The update times themselves are kept in the cache, so that the scheduler only has to read the percentiles
+    durations = (user.cache.get("update_durations", None) or [])[-(USER_AUTO_UPDATE_DURATION_HISTORY - 1):] + [duration]
+    user.cache["update_durations"] = durations
+    user.sync_state["duration_p95"] = utils.percentile(durations, 0.95)
+    user.write({
+        f'cache/{user.uid}/update_durations': durations,
+        f'sync_state/{user.uid}/duration_p95': user.sync_state["duration_p95"]
+    })
 
 
-@utils.wrap_async_exceptions
-async def update_calendar_for_user(uid) -> None:
+async def update_event_cache_for_user(user: utils.UserContext, gradescope_connector: aiohttp.BaseConnector) -> None:
+    """
+    Updates the assignment cache for a single user and stores the updated cache in the database.
+    """
+    # Skip the update if Gradescope is down
+    utils.gradescope_circuit.raise_if_open()
+
+    fernet = get_fernet()
+
+    # Check that the user has valid settings and a valid Gradescope token
+    if ((user_settings := utils.get_user_settings(user)) and
+            (gradescope_token := await utils.run_blocking(get_gradescope_token, user, fernet))):
+        # Update the user's assignment cache
+        stored_assignment_cache = user.assignments
+        parse_executor = utils.get_parse_executor(COURSE_PAGE_PARSE_EXECUTOR, COURSE_PAGE_PARSE_WORKERS)
+        if (updated_cache := await get_updated_assignment_cache(user, user_settings, gradescope_token, fernet,
+                                                                utils.AssignmentCache(stored_assignment_cache),
+                                                                gradescope_connector, parse_executor)) is None:
+            return
+        assignment_cache, course_fingerprints = updated_cache
+
+        # Store the changes to the cache in the database
+        # (along with the fingerprints of the course pages it was built from, so unchanged pages can be skipped later)
+        assignment_changes = assignment_cache.get_db_delta(f'assignments/{user.uid}', stored_assignment_cache)
+        if assignment_changes:
+            # Remember when the user's assignments last changed (see schedule_next_sync)
+            user.sync_state["last_changed_at"] = time.time()
+            assignment_changes[f'sync_state/{user.uid}/last_changed_at'] = user.sync_state["last_changed_at"]
+        await utils.run_blocking(user.write, {
+            **assignment_changes,
+            **utils.get_db_delta(f'cache/{user.uid}/course_fingerprints', user.cache.get("course_fingerprints", None),
+                                 course_fingerprints)
+        })
+        user.assignments = assignment_cache
+        user.cache["course_fingerprints"] = course_fingerprints
+
+
+async def update_calendar_for_user(user: utils.UserContext) -> None:
     """
     Updates the calendar for a single user using the user's assignment cache.
     """
     # Check that the user has valid settings
-    if not (user_settings := utils.get_user_settings(uid)):
+    if not (user_settings := utils.get_user_settings(user)):
         return
 
+    # Skip the update if Google is down
+    utils.google_circuit.raise_if_open()
+
     # Connect to the Google Calendar API
-    with build_google_api_service('calendar', 'v3', credentials=login_to_google(uid, get_fernet())
-                                  ) as calendar_service:
+    with await build_calendar_service(user, get_fernet()) as calendar_service:
 
         # Validate the user's calendar ID
-        if not utils.validate_calendar_id(user_settings["calendar_id"], calendar_service):
-            db.reference(f'settings/{uid}/calendar_id').set("invalid")
+        if not await utils.run_blocking(utils.validate_calendar_id_with_cache, user, user_settings["calendar_id"],
+                                        calendar_service, CALENDAR_VALIDATION_TTL):
+            user_settings["calendar_id"] = "invalid"
+            await utils.run_blocking(user.write, {f'settings/{user.uid}/calendar_id': "invalid"})
             return
 
         # Get the user's assignment cache (if it exists)
-        if not (assignment_cache := utils.get_db_ref_as_type(f'assignments/{uid}', dict)):
+        if not (stored_assignment_cache := user.assignments):
             return
 
         # Update the user's calendar using the assignment cache
-        await update_calendar_from_cache(uid, calendar_service, user_settings, assignment_cache)
+        await update_calendar_from_cache(user, calendar_service, user_settings, stored_assignment_cache,
+                                         utils.AssignmentCache(stored_assignment_cache))
 
 
-async def get_updated_assignment_cache(uid: str, user_settings: dict[str, Any], gradescope_token: str) \
-        -> dict[str, Any]:
+async def get_updated_assignment_cache(user: utils.UserContext, user_settings: dict[str, Any], gradescope_token: str,
+                                       fernet: Fernet, assignment_cache: utils.AssignmentCache,
+                                       gradescope_connector: Optional[aiohttp.BaseConnector] = None,
+                                       parse_executor: Optional[Executor] = None) \
+        -> Optional[tuple[utils.AssignmentCache, dict[str, str]]]:
     """
-    Updates the user's assignment cache with new data from Gradescope and returns the updated cache.
+    Updates the user's assignment cache with new data from Gradescope and returns the updated cache and the fingerprints
+    of the course pages it was built from, or None if the user's Gradescope token is invalid and could not be refreshed.
+    Courses whose pages haven't changed since they were last parsed are skipped, keeping their cached assignments.
     """
-    # Get the user's assignments from Gradescope
-    assignments = await utils.enumerate_gradescope_assignments(user_settings["courses"], gradescope_token)
+    # Get the fingerprints of the course pages from the last update (if they exist)
+    course_fingerprints = user.cache.get("course_fingerprints", None) or {}
 
-    # Get the user's assignment cache (if it exists)
-    assignment_cache = utils.get_db_ref_as_type(f'assignments/{uid}', dict) or {}
-    # Filter out assignments that are not in the user's current course list
-    assignment_cache = {assignment_id: assignment for assignment_id, assignment in assignment_cache.items() if
-                        assignment["course_id"] in user_settings["courses"]}
+    # Get the user's assignments from Gradescope
+    try:
+        assignments, course_fingerprints = await utils.enumerate_gradescope_assignments(
+            user_settings["courses"], gradescope_token, gradescope_connector, course_fingerprints, parse_executor)
+    except utils.GradescopeAuthError:
+        # The token may not have been validated before it was used, so try logging in again before giving up
+        if not (gradescope_token := await utils.run_blocking(utils.refresh_gradescope_token, user, fernet)):
+            return None
+        assignments, course_fingerprints = await utils.enumerate_gradescope_assignments(
+            user_settings["courses"], gradescope_token, gradescope_connector, course_fingerprints, parse_executor)
+
+    # Assignments from courses which are no longer in the user's course list are kept until their events have been
+    # deleted (see reconcile_calendar)
 
     # For each assignment
     for assignment_id, assignment in assignments.items():
         # If the assignment is completed but not in the cache (there's no event for it), skip it
-        if assignment["completed"] and assignment_id not in assignment_cache:
+        if assignment.completed and assignment_id not in assignment_cache:
             continue
 
         # Update the assignment in the cache with the new data from Gradescope
         assignment_cache[assignment_id] = utils.update_gradescope_assignment(assignment,
                                                                              assignment_cache.get(assignment_id, None))
 
-    return assignment_cache
+    return assignment_cache, course_fingerprints
 
 
-async def update_calendar_from_cache(uid: str, calendar_service: Any, user_settings: dict[str, Any],
-                                     assignment_cache: utils.AssignmentList) -> None:
+async def update_calendar_from_cache(user: utils.UserContext, calendar_service: Any, user_settings: dict[str, Any],
+                                     stored_assignment_cache: utils.AssignmentCache,
+                                     assignment_cache: utils.AssignmentCache) -> None:
+    """
+    Updates the user's calendar to match their assignment cache and stores the updated cache in the database.
+    stored_assignment_cache must be the cache as it is currently stored in the database, so that only the changes to
+    the cache need to be written.
+    """
     completed_assignment_color = user_settings["completed_assignment_color"]
+    now = time.time()
+
+    # Repair any changes made to the calendar outside of this app first, so the repairs are sent with the other updates
+    calendar_sync = await reconcile_calendar(user, calendar_service, user_settings, assignment_cache)
+
+    # The requests needed to update the user's calendar and the assignments (and hashes of the events) they are for,
+    # keyed by assignment ID
+    calendar_requests = {}
+    updated_assignments = {}
+
+    # For each assignment in the cache (Iterate over a copy, so we can modify the cache while iterating)
+    for assignment_id, assignment in list(assignment_cache.items()):
+        # Completed assignments are kept in the cache until they are due, so that if they are marked as incomplete
+        # again, their events are reused instead of duplicated (After that, Gradescope stops listing them, so they can't
+        # change again, and we don't need them later)
+        if assignment.completed and ((due_date := assignment.get_due_datetime()) is None or
+                                     due_date.timestamp() <= now):
+            assignment_cache.pop(assignment_id, None)
 
-    # Create a batch request to update the user's calendar
-    event_update_batch = calendar_service.new_batch_http_request()
-
-    def update_cache(updated_assignment):
-        """
-        Returns a callback that updates the assignment cache with the event ID of the updated assignment.
-        This can be used as a callback for the Google Calendar API. When the request to create an event completes,
-        it's response will contain the event ID, which we can use to update the assignment cache.
-        """
-
-        def update_cache_helper(_request_id, response, _exception):
-            # updated_assignment is a reference to the assignment in the cache, so we can modify it directly
-            updated_assignment["event_id"] = response["id"]
-
-        return update_cache_helper
+        course = user_settings["courses"].get(assignment.course_id, {})
 
-    # For each assignment in the cache (Create a copy, so we can modify the cache while iterating)
-    for assignment_id, assignment in assignment_cache.copy().items():
-        # If the assignment is completed, remove it from the cache
-        # (We'll mark it as completed during the lope, but we don't need it later)
-        if assignment["completed"]:
-            assignment_cache.pop(assignment_id, None)
+        # Hash the event the assignment should have, to check whether it has changed since it was last sent
+        # (If the course doesn't have enough information to create an event, there's nothing to send)
+        if (event_hash := utils.get_assignment_event_hash(course, assignment, completed_assignment_color)) is None:
+            continue
 
         # If the assignment has an event associated with it
-        if assignment["event_id"]:
-            # And something about the assignment has changed
-            if (completed_assignment_color and assignment["completed"]) or assignment["outdated"]:
-                assignment["outdated"] = False  # Mark the assignment as up-to-date
-                # Update the event
-                utils.patch_assignment_event(calendar_service, event_update_batch, user_settings["calendar_id"],
-                                             user_settings["courses"].get(assignment["course_id"], {}), assignment,
-                                             completed_assignment_color)
+        if assignment.event_id:
+            # Events from before events were hashed are assumed to be up-to-date, unless the assignment says otherwise
+            if not assignment.event_hash and not assignment.outdated and \
+                    not (completed_assignment_color and assignment.completed):
+                if assignment_id in assignment_cache:
+                    assignment_cache[assignment_id] = dataclasses.replace(assignment, event_hash=event_hash)
+                continue
+            # Only update the event if something about it has changed
+            if event_hash == assignment.event_hash and not assignment.outdated:
+                continue
+            request = utils.patch_assignment_event(calendar_service, user_settings["calendar_id"], course,
+                                                   assignment, completed_assignment_color)
 
         # Otherwise, if the assignment doesn't have an event associated with it and is not yet completed
-        elif not assignment["completed"]:
+        elif not assignment.completed:
 
             # Create an event for it
-            utils.create_assignment_event(calendar_service, event_update_batch, user_settings["calendar_id"],
-                                          user_settings["courses"].get(assignment["course_id"], {}), assignment,
-                                          completed_assignment_color, update_cache(assignment))
+            request = utils.create_assignment_event(calendar_service, user_settings["calendar_id"], user.uid, course,
+                                                    assignment_id, assignment, completed_assignment_color)
+        else:
+            continue
+
+        calendar_requests[assignment_id] = request
+        updated_assignments[assignment_id] = (assignment, event_hash)
+
+    # Execute the requests in batches (retrying any that fail transiently)
+    outcomes = await utils.execute_calendar_requests(calendar_service, calendar_requests, CALENDAR_BATCH_CONCURRENCY,
+                                                     CALENDAR_BATCH_MAX_RETRIES)
 
-    # Execute the batch request asynchronously
-    await asyncio.get_running_loop().run_in_executor(None, event_update_batch.execute)
+    calendar_access_lost = False
+    for assignment_id, (response, exception) in outcomes.items():
+        assignment, event_hash = updated_assignments[assignment_id]
 
-    # Store the updated assignment cache in the database
-    db.reference(f'assignments/{uid}').set(assignment_cache)
+        if exception is None:
+            # Mark the assignment as up-to-date, and save the event's ID (if we created it), so we can update the event
+            # later, and its hash, so we only update it when it changes
+            if assignment_id in assignment_cache:
+                assignment_cache[assignment_id] = dataclasses.replace(
+                    assignment, event_id=assignment.event_id or response["id"], outdated=False, event_hash=event_hash)
+            continue
+
+        print(f"Failed to update the event for assignment {assignment_id}: {exception}")
+        calendar_access_lost = calendar_access_lost or utils.is_calendar_access_error(exception)
+
+        # If a patch ran out of retries, keep the assignment in the cache and mark it as outdated, so the patch is
+        # tried again next time
+        # (Failed creations don't need this, since assignments without an event are always retried)
+        if assignment.event_id and (utils.is_retryable_calendar_error(exception) or
+                                    isinstance(exception, utils.CircuitOpenError)):
+            assignment_cache[assignment_id] = dataclasses.replace(assignment, outdated=True)
+        # Patches which can't succeed (e.g. because the event was deleted) aren't tried again until the event changes
+        elif assignment.event_id and assignment_id in assignment_cache:
+            assignment_cache[assignment_id] = dataclasses.replace(assignment, outdated=False, event_hash=event_hash)
+
+    # If the calendar rejected any requests, make sure it is validated again before it is next used
+    if calendar_access_lost:
+        await utils.run_blocking(utils.invalidate_calendar_validation, user)
+
+    # Store the changes to the assignment cache in the database
+    # (along with the calendar's new sync token, so that the changes it covers are only repaired once)
+    await utils.run_blocking(user.write, {
+        **assignment_cache.get_db_delta(f'assignments/{user.uid}', stored_assignment_cache),
+        **utils.get_db_delta(f'cache/{user.uid}/calendar_sync', user.cache.get("calendar_sync", None), calendar_sync)
+    })
+    user.assignments = assignment_cache
+    user.cache["calendar_sync"] = calendar_sync
+
+    # If Google went down partway through, let the caller know that the update didn't finish
+    if any(isinstance(exception, utils.CircuitOpenError) for _response, exception in outcomes.values()):
+        raise utils.CircuitOpenError("Google went down while the calendar was being updated")
+
+
+async def reconcile_calendar(user: utils.UserContext, calendar_service: Any, user_settings: dict[str, Any],
+                             assignment_cache: utils.AssignmentCache) -> dict[str, str]:
+    """
+    Repairs the differences between the user's calendar and their assignment cache, updating assignment_cache in place,
+    and returns the calendar's new sync state (to store at cache/{uid}/calendar_sync).
+    Only the events which have changed since the last reconciliation are listed (see
+    utils.list_changed_calendar_events).
+    Events which were deleted are forgotten, so they are created again, and events which were changed are marked as
+    outdated, so they are patched back. Events this app created for an assignment which has a different event in the
+    cache (duplicates), and the events of courses which were removed from the user's settings, are deleted. (Events of
+    assignments which aren't in the cache are kept, since completed assignments are dropped from the cache once they
+    are due, but their events stay in the calendar.)
+    """
+    calendar_id = user_settings["calendar_id"]
+    completed_assignment_color = user_settings["completed_assignment_color"]
+    calendar_sync = user.cache.get("calendar_sync", None) or {}
+    # A sync token is only valid for the calendar it was issued for
+    sync_token = (calendar_sync.get("sync_token", None) if calendar_sync.get("calendar_id", None) == calendar_id
+                  else None)
+
+    # The events to delete, mapped to the assignments they belonged to (if they are in the cache)
+    orphaned_events = {}
+
+    # Delete the events of courses which are no longer in the user's course list (and forget their assignments)
+    for assignment_id, assignment in list(assignment_cache.items()):
+        if assignment.course_id not in user_settings["courses"]:
+            assignment_cache.pop(assignment_id)
+            if assignment.event_id:
+                orphaned_events[assignment.event_id] = (assignment_id, assignment)
+
+    # Find the events which have changed since the last reconciliation
+    next_sync_token = None
+    try:
+        try:
+            events, next_sync_token = await utils.run_blocking(utils.list_changed_calendar_events, calendar_service,
+                                                               calendar_id, sync_token, CALENDAR_SYNC_PAGE_SIZE)
+        except utils.CalendarSyncTokenExpiredError:
+            # Start over by listing every event
+            events, next_sync_token = await utils.run_blocking(utils.list_changed_calendar_events, calendar_service,
+                                                               calendar_id, None, CALENDAR_SYNC_PAGE_SIZE)
+    except utils.CircuitOpenError:
+        events = []
+    except Exception as e:
+        # The calendar can still be updated without reconciling it
+        utils.report_exception(e)
+        events = []
+
+    assignment_ids_by_event_id = {assignment.event_id: assignment_id
+                                  for assignment_id, assignment in assignment_cache.items() if assignment.event_id}
+    for event in events:
+        deleted = event.get("status", None) == "cancelled"
+
+        # If the event belongs to an assignment in the cache
+        if (assignment_id := assignment_ids_by_event_id.get(event["id"], None)) is not None:
+            assignment = assignment_cache[assignment_id]
+            course = user_settings["courses"].get(assignment.course_id, {})
+            if deleted:
+                # Forget the event, so that it is created again (unless the assignment is completed)
+                assignment_cache[assignment_id] = dataclasses.replace(assignment, event_id="", event_hash="",
+                                                                      outdated=False)
+            elif (not assignment.outdated and
+                  (expected_event := utils.build_assignment_event(course, assignment, completed_assignment_color)) and
+                  not utils.assignment_event_matches(event, expected_event)):
+                # Patch the event back to how it should be
+                assignment_cache[assignment_id] = dataclasses.replace(assignment, outdated=True)
+
+        # Otherwise, if this app created it for this user (other users may share the calendar) for an assignment which
+        # has another event, it's a duplicate (e.g. from an update whose changes to the cache were lost), and if it's
+        # for a course which was removed, it isn't needed
+        elif not deleted and (tagged_assignment_id := utils.get_assignment_event_tag(event, user.uid)) is not None:
+            tagged_assignment = assignment_cache.get(tagged_assignment_id, None)
+            if tagged_assignment is not None and not tagged_assignment.event_id:
+                # If the assignment lost track of its event, adopt the event again (and patch it to be safe)
+                assignment_cache[tagged_assignment_id] = dataclasses.replace(tagged_assignment, event_id=event["id"],
+                                                                             event_hash="", outdated=True)
+                assignment_ids_by_event_id[event["id"]] = tagged_assignment_id
+            elif tagged_assignment is not None or tagged_assignment_id.split("-", 1)[0] not in user_settings["courses"]:
+                orphaned_events.setdefault(event["id"], None)
+
+    # Delete the orphaned events
+    delete_requests = {event_id: utils.delete_assignment_event(calendar_service, calendar_id, event_id)
+                       for event_id in orphaned_events}
+    outcomes = await utils.execute_calendar_requests(calendar_service, delete_requests, CALENDAR_BATCH_CONCURRENCY,
+                                                     CALENDAR_BATCH_MAX_RETRIES)
+    deletions_failed = False
+    for event_id, (_response, exception) in outcomes.items():
+        # Events which are already gone don't need to be deleted
+        if exception is None or (isinstance(exception, HttpError) and exception.status_code in (404, 410)):
+            continue
+        print(f"Failed to delete orphaned event {event_id}: {exception}")
+        deletions_failed = True
+        # Keep the event's assignment in the cache, so that the deletion is tried again next time
+        if orphaned_events[event_id] is not None:
+            assignment_id, assignment = orphaned_events[event_id]
+            assignment_cache[assignment_id] = assignment
+
+    # Only move on to the new sync token once everything it covers has been handled (If any deletions failed, the same
+    # events are listed again next time)
+    if next_sync_token is None or deletions_failed:
+        return calendar_sync
+    return {"calendar_id": calendar_id, "sync_token": next_sync_token}
@@ -1,14 +1,30 @@
 import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import dataclasses
 import functools
+import hashlib
 import json
+import math
+import multiprocessing
+import random
 import re
 import requests
+import threading
+import time
+import urllib.parse
+import uuid
+import weakref
 
 import aiohttp
+import httplib2
 from aiohttp import CookieJar
 from lxml import etree
-from datetime import datetime
-from typing import Any, TypeVar, Callable, cast, Type, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Awaitable, TypeVar, Callable, cast, Type, Optional, Iterable, Iterator
 
 from cryptography.fernet import Fernet
 
@@ -18,35 +34,437 @@ from firebase_functions.params import SecretParam
 from firebase_functions.options import SupportedRegion
 
 import google.auth
-from google.auth.exceptions import RefreshError
+from google.auth.exceptions import RefreshError, TransportError
 from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
 
 # The format of the datetime strings returned by Gradescope
 GRADESCOPE_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+# The same format as a pattern, to convert the datetime strings to ISO format without parsing them
+GRADESCOPE_DATETIME_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2}) (\d{2}:\d{2}:\d{2}) ([+-]\d{2})(\d{2})')
 # The scopes required by the Google Calendar API
 GOOGLE_API_SCOPES = [
     "https://www.googleapis.com/auth/calendar.calendarlist.readonly",
     "https://www.googleapis.com/auth/calendar.events"
 ]
+# Cached Google access tokens are refreshed once they are within this much time of expiring
+# (This should cover the longest time a single update might use the token for)
+GOOGLE_ACCESS_TOKEN_EXPIRY_MARGIN = timedelta(minutes=10)
+# The number of seconds to wait for Gradescope to accept a connection, and then to send each part of its response
+# (Without these, a hung Gradescope would hold each request for minutes before its circuit breaker saw a failure)
+GRADESCOPE_CONNECT_TIMEOUT = 10
+GRADESCOPE_READ_TIMEOUT = 30
+# The same timeouts, for requests made with the requests library
+GRADESCOPE_REQUEST_TIMEOUT = (GRADESCOPE_CONNECT_TIMEOUT, GRADESCOPE_READ_TIMEOUT)
+# The number of bytes before a page section's marker which are kept, to find the start of the tag it is in
+PAGE_SECTION_LOOKBEHIND = 4096
+# The maximum number of requests Google Calendar accepts in a single batch
+GOOGLE_CALENDAR_BATCH_LIMIT = 50
+# The private extended property which marks the events this app creates, holding the ID of the event's assignment
+ASSIGNMENT_EVENT_PROPERTY = "gradescope_assignment_id"
+# The private extended property which holds the UID of the user an event was created for (Several users can share a
+# calendar, so each of them must only reconcile their own events)
+ASSIGNMENT_EVENT_OWNER_PROPERTY = "gradescope_calendar_uid"
+# The fields of each event which are needed to reconcile a calendar with the assignment cache (see
+# list_changed_calendar_events)
+CALENDAR_SYNC_FIELDS = "items(id,status,summary,colorId,start,end,extendedProperties),nextPageToken,nextSyncToken"
 
 # A bunch of type definitions
 T = TypeVar('T')
 U = TypeVar('U')
-Assignment = dict[str, str | bool]
-AssignmentList = dict[str, Assignment]
+AssignmentList = dict[str, "AssignmentRecord"]
 Course = dict[str, str]
 CourseList = dict[str, Course]
 CourseSettings = dict[str, str]
 Calendar = dict
 CallableFunctionResponse = str | dict
+CalendarRequestOutcome = tuple[Any, Exception | None]  # (response, exception)
 UserSettings = dict[str, Any]
 
+# Counters which track how often the various caches and shortcuts are used (These are reported after each batch)
+stats = collections.Counter()
+
+
+# region Circuit Breakers
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of making a request to an upstream service whose circuit breaker is open
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Tracks the error rate of requests to an upstream service (shared by everything this instance does), and stops
+    requests from being made to the service while it seems to be down, so that a batch doesn't spend its whole time
+    limit on requests which are going to fail.
+
+    The breaker opens once at least failure_threshold of the last window_size requests have failed. After cooldown
+    seconds, it lets a single probe request through: if the probe succeeds, the breaker closes, otherwise it stays open
+    for another cooldown.
+    """
+
+    def __init__(self, name: str, failure_threshold: float = 0.5, window_size: int = 20, min_requests: int = 5,
+                 cooldown: float = 60):
+        """
+        Args:
+            name: The name of the service (used in logs)
+            failure_threshold: The fraction of recent requests which must fail for the breaker to open
+            window_size: The number of recent requests to track
+            min_requests: The number of requests which must be tracked before the breaker can open
+            cooldown: The number of seconds to wait before probing the service once the breaker has opened
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self._outcomes = collections.deque(maxlen=window_size)
+        self._opened_at = None
+        self._probe_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def healthy(self) -> bool:
+        """
+        Whether the breaker is closed (i.e. the service seems to be up)
+        """
+        return self._opened_at is None
+
+    def raise_if_open(self) -> None:
+        """
+        Raises a CircuitOpenError if the breaker is open and isn't ready to be probed, without starting a probe
+        (Use this to skip work which would end up making requests to the service)
+        """
+        with self._lock:
+            if self._opened_at is not None and not self._can_probe():
+                stats[f'{self.name.lower()}_circuit_rejections'] += 1
+                raise CircuitOpenError(f"{self.name} seems to be down")
+
+    def before_request(self) -> None:
+        """
+        Checks whether a request can be made to the service, starting a probe if the breaker is ready for one
+
+        Raises:
+            CircuitOpenError: If the request shouldn't be made
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if not self._can_probe():
+                stats[f'{self.name.lower()}_circuit_rejections'] += 1
+                raise CircuitOpenError(f"{self.name} seems to be down")
+            self._probe_started_at = time.monotonic()
+
+    def _can_probe(self) -> bool:
+        # A probe which never reported back (ex. because its caller gave up) is replaced after a cooldown
+        now = time.monotonic()
+        return (now - self._opened_at >= self.cooldown and
+                (self._probe_started_at is None or now - self._probe_started_at >= self.cooldown))
+
+    def record_success(self) -> None:
+        """
+        Records that a request to the service succeeded (or failed in a way which shows that the service is up)
+        """
+        with self._lock:
+            if self._opened_at is None:
+                self._outcomes.append(True)
+            elif self._probe_started_at is not None:
+                print(f"{self.name} has recovered, closing its circuit breaker")
+                self._opened_at = self._probe_started_at = None
+                self._outcomes.clear()
+
+    def record_failure(self) -> None:
+        """
+        Records that a request to the service failed because the service seems to be down
+        """
+        with self._lock:
+            if self._opened_at is not None:
+                if self._probe_started_at is not None:
+                    # The probe failed, so wait for another cooldown
+                    self._opened_at = time.monotonic()
+                    self._probe_started_at = None
+                return
+
+            self._outcomes.append(False)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_requests and failures / len(self._outcomes) >= self.failure_threshold:
+                print(f"{self.name} seems to be down ({failures} of the last {len(self._outcomes)} requests failed), "
+                      f"opening its circuit breaker")
+                stats[f'{self.name.lower()}_circuit_opened'] += 1
+                self._opened_at = time.monotonic()
+
+    @contextlib.contextmanager
+    def guard(self, outage_errors: tuple[Type[BaseException], ...]) -> Iterator[None]:
+        """
+        Wraps a request to the service: raises a CircuitOpenError instead of making the request if the breaker is open,
+        and records the request as a failure if it raises one of outage_errors, or as a success otherwise
+        """
+        self.before_request()
+        try:
+            yield
+        except outage_errors:
+            self.record_failure()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        else:
+            self.record_success()
+
+
+# endregion
+
+# region Rate Limiting
+
+
+class AdaptiveRateLimiter:
+    """
+    Limits the rate of requests (shared by everything this instance does) to an upstream service with a token bucket,
+    and the number of requests in flight to the number needed to sustain that rate at the target latency.
+
+    The rate adapts with additive increase/multiplicative decrease: each request which succeeds within the target
+    latency raises it a little (by about additive_increase requests per second, per second), while each request which
+    is throttled or slow cuts it by multiplicative_decrease (at most once per target latency, so that one burst of
+    failures doesn't collapse it). The rate never goes above the ceiling, which is this instance's share of a budget
+    shared by every instance (see share_budget).
+    """
+
+    def __init__(self, name: str, initial_rate: float = 5, min_rate: float = 0.5, max_rate: float = 20,
+                 latency_target: float = 2, additive_increase: float = 1, multiplicative_decrease: float = 0.5,
+                 burst: float = 5):
+        """
+        Args:
+            name: The name of the service (used in logs and stats)
+            initial_rate: The number of requests per second to start at
+            min_rate: The lowest the rate can be decreased to
+            max_rate: The highest the rate can be increased to (regardless of this instance's share of the budget)
+            latency_target: The number of seconds a request can take before it is considered slow
+            additive_increase: How quickly the rate increases while requests are succeeding
+            multiplicative_decrease: The factor the rate is multiplied by when a request is throttled or slow
+            burst: The maximum number of requests which can be made at once after a quiet period
+        """
+        self.name = name
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.ceiling = max_rate
+        self.latency_target = latency_target
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.burst = burst
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0
+        self._in_flight = 0
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+
+    @property
+    def concurrency(self) -> int:
+        """
+        The maximum number of requests in flight (enough to sustain the current rate at the target latency)
+        """
+        return max(1, math.ceil(self.rate * self.latency_target))
+
+    @contextlib.asynccontextmanager
+    async def limit(self, throttle_errors: tuple[Type[BaseException], ...]) -> AsyncIterator[None]:
+        """
+        Waits until a request can be made to the service, then times the request and adjusts the rate based on it
+        (Requests which raise one of throttle_errors count as throttled)
+        """
+        await self._acquire()
+        start_time = time.monotonic()
+        try:
+            yield
+        except throttle_errors:
+            self._decrease()
+            raise
+        else:
+            if time.monotonic() - start_time > self.latency_target:
+                self._decrease()
+            else:
+                self._increase()
+        finally:
+            self._release()
+
+    async def _acquire(self) -> None:
+        # Wait for a free slot
+        if self._in_flight < self.concurrency:
+            self._in_flight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter  # (The slot is taken for this request when the future is resolved)
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release()
+                raise
+
+        # Then wait for a token
+        try:
+            waited = False
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                if not waited:
+                    stats[f'{self.name.lower()}_rate_limited'] += 1
+                    waited = True
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+        except asyncio.CancelledError:
+            self._release()
+            raise
+
+    def _release(self) -> None:
+        self._in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self._in_flight < self.concurrency:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+    def _increase(self) -> None:
+        self.rate = min(self.ceiling, self.rate + self.additive_increase / self.rate)
+        self._wake_waiters()
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.latency_target:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.multiplicative_decrease)
+        stats[f'{self.name.lower()}_rate_decreases'] += 1
+
+    def set_ceiling(self, ceiling: float) -> None:
+        """
+        Sets the highest the rate can go (this is capped at max_rate)
+        """
+        self.ceiling = max(self.min_rate, min(self.max_rate, ceiling))
+        self.rate = min(self.rate, self.ceiling)
+
+    @contextlib.asynccontextmanager
+    async def share_budget(self, path: str, default_budget: float, interval: float = 30) -> AsyncIterator[None]:
+        """
+        While in this context, shares a budget of requests per second with the other instances which are making requests
+        to the service, by registering this instance under path in the database and keeping the ceiling at an even share
+        of the budget stored there
+
+        Args:
+            path: The path in the database of the budget (see database_structure.json)
+            default_budget: The budget to use if none is stored in the database
+            interval: The number of seconds between updates of the share (Instances which don't update their
+                      registration for twice this long are considered to have stopped)
+        """
+
+        # Each use of the context registers separately, so that leaving one doesn't unregister another
+        registration_id = uuid.uuid4().hex
+
+        async def update_budget_share() -> None:
+            try:
+                await run_blocking(self._update_budget_share, path, default_budget, 2 * interval, registration_id)
+            except Exception as e:
+                print(f"Failed to update the {self.name} request budget: {e}")
+
+        async def keep_budget_share_updated() -> None:
+            while True:
+                await asyncio.sleep(interval)
+                await update_budget_share()
+
+        # Get a share before any requests are made
+        await update_budget_share()
+        updater = asyncio.create_task(keep_budget_share_updated())
+        try:
+            yield
+        finally:
+            updater.cancel()
+            try:
+                await run_blocking(db.reference(f'{path}/workers/{registration_id}').delete)
+            except Exception as e:
+                print(f"Failed to unregister from the {self.name} request budget: {e}")
+            self.set_ceiling(self.max_rate)
+
+    def _update_budget_share(self, path: str, default_budget: float, registration_ttl: float,
+                             registration_id: str) -> None:
+        budget = db.reference(path).get() or {}
+        now = time.time()
+        other_workers = {worker_id: expires_at for worker_id, expires_at in (budget.get("workers", None) or {}).items()
+                         if worker_id != registration_id}
+
+        # Renew this instance's registration and clean up the registrations of instances which have stopped
+        updates = {f'workers/{registration_id}': now + registration_ttl}
+        updates.update({f'workers/{worker_id}': None for worker_id, expires_at in other_workers.items()
+                        if expires_at <= now})
+        db.reference(path).update(updates)
+
+        active_workers = 1 + sum(1 for expires_at in other_workers.values() if expires_at > now)
+        self.set_ceiling(budget.get("requests_per_second", default_budget) / active_workers)
+
+
+# endregion
 
 # region Gradescope
 
 
+class GradescopeAuthError(RuntimeError):
+    """
+    Raised when Gradescope rejects a request because the user's token is invalid
+    """
+    pass
+
+
+class GradescopeUnavailableError(RuntimeError):
+    """
+    Raised when Gradescope fails to respond to a request because of a problem on its end
+    """
+    pass
+
+
+class GradescopeRateLimitError(RuntimeError):
+    """
+    Raised when Gradescope rejects a request because too many requests have been made
+    """
+    pass
+
+
+# The errors which indicate that Gradescope is down (rather than that a request was bad)
+GRADESCOPE_OUTAGE_ERRORS = (GradescopeUnavailableError, requests.RequestException, aiohttp.ClientError,
+                            asyncio.TimeoutError)
+# Stops requests to Gradescope while it is down (see CircuitBreaker)
+gradescope_circuit = CircuitBreaker("Gradescope")
+# The errors which indicate that Gradescope wants requests to slow down
+GRADESCOPE_THROTTLE_ERRORS = (GradescopeRateLimitError, GradescopeUnavailableError, asyncio.TimeoutError)
+# The limiters for the rate of requests for Gradescope pages, by the event loop which uses them
+# (The limiters hold futures and counters which belong to a single loop, and each invocation runs its own loop)
+_gradescope_rate_limiters: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AdaptiveRateLimiter] = \
+    weakref.WeakKeyDictionary()
+_gradescope_rate_limiters_lock = threading.Lock()
+
+
+def get_gradescope_rate_limiter() -> AdaptiveRateLimiter:
+    """
+    Gets the limiter for the rate of requests for Gradescope pages made from the running event loop
+
+    Returns:
+        The limiter for the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    with _gradescope_rate_limiters_lock:
+        if loop not in _gradescope_rate_limiters:
+            _gradescope_rate_limiters[loop] = AdaptiveRateLimiter("Gradescope")
+        return _gradescope_rate_limiters[loop]
+
+
 def check_gradescope_token(token: Any) -> bool:
     """
     Checks if a Gradescope token is valid
@@ -56,6 +474,10 @@ def check_gradescope_token(token: Any) -> bool:
 
     Returns:
         True if the token is valid, False otherwise
+
+    Raises:
+        GradescopeUnavailableError: If Gradescope is down (in which case the token may still be valid)
+        CircuitOpenError: If Gradescope's circuit breaker is open
     """
     # The token must be a string
     if not isinstance(token, str):
@@ -65,55 +487,125 @@ def check_gradescope_token(token: Any) -> bool:
     # Note: If the user is logged in, this returns the course list, so this could be used to add a course update feature
     # whenever the Gradescope token is validated, but ATM, I don't know if I want to do that EVERY TIME the token is
     # validated, and I don't want to rewrite this function to add that functionality. Maybe later.
-    with requests.get("https://www.gradescope.com/account", cookies={"signed_token": token},
-                      allow_redirects=False) as response:
+    with gradescope_circuit.guard(GRADESCOPE_OUTAGE_ERRORS), \
+            requests.get("https://www.gradescope.com/account", cookies={"signed_token": token},
+                         allow_redirects=False, timeout=GRADESCOPE_REQUEST_TIMEOUT) as response:
+        if response.status_code >= 500:
+            raise GradescopeUnavailableError(f"Gradescope Error: {response.status_code}!")
         return response.status_code == 200
 
 
-def get_gradescope_token(uid: str, fernet: Fernet) -> str | None:
+def get_gradescope_token(user: "UserContext", fernet: Fernet, validation_ttl: float = 0, optimistic: bool = False) \
+        -> str | None:
     """
     Gets the Gradescope token for a user from the database. If the token is invalid, this method will attempt to log in
     to Gradescope with the user's credentials (if available) and refresh the token.
 
+    Validating the token costs a request to Gradescope, so it is skipped if the token was validated less than
+    validation_ttl seconds ago, or entirely if optimistic is True. Callers which skip validation must handle a
+    GradescopeAuthError from the requests they make with the token by calling refresh_gradescope_token.
+
     Args:
-        uid: The user's UID
+        user: The user's data
         fernet: The Fernet object to use to decrypt the token
+        validation_ttl: The number of seconds for which a successful validation of the token is trusted
+        optimistic: Whether to skip validating the token altogether
 
     Returns:
         The user's Gradescope token, or None if a token could not be obtained
     """
     # Has the user linked their Gradescope account?
-    if not db.reference(f'auth_status/{uid}/gradescope').get():
+    if not user.auth_status.get("gradescope", False):
         return None
-    gradescope_token = get_db_ref_as_type(f'credentials/{uid}/gradescope/token', str)
+    gradescope_credentials = user.credentials.setdefault("gradescope", {})
+
+    if not (gradescope_token := gradescope_credentials.get("token", None)):
+        return refresh_gradescope_token(user, fernet)
 
-    if gradescope_token:  # If we have a token, decrypt it
-        gradescope_token = fernet_decrypt(gradescope_token, fernet)
+    # If we have a token, decrypt it
+    gradescope_token = fernet_decrypt(gradescope_token, fernet)
+
+    # Do we trust the saved token without checking it?
+    if optimistic or time.time() - gradescope_credentials.get("validated_at", 0) < validation_ttl:
+        return gradescope_token
 
     # Is the saved token valid?
     if not check_gradescope_token(gradescope_token):
-        # If not, do we have credentials to log in to Gradescope?
-        gradescope_token = None
-        gradescope_email = get_db_ref_as_type(f'credentials/{uid}/gradescope/email', str)
-        gradescope_password = get_db_ref_as_type(f'credentials/{uid}/gradescope/password', str)
-        if gradescope_email and gradescope_password:
-            # If so, log in to Gradescope and get a new token
-            gradescope_token = login_to_gradescope(
-                fernet_decrypt(gradescope_email, fernet),
-                fernet_decrypt(gradescope_password, fernet)
-            )
-
-        # If we still don't have a token, the user needs to relink their Gradescope account
-        if not gradescope_token:
-            db.reference(f'auth_status/{uid}/gradescope').set(False)
-            return None
+        return refresh_gradescope_token(user, fernet)
+
+    gradescope_credentials["validated_at"] = time.time()
+    user.write({f'credentials/{user.uid}/gradescope/validated_at': gradescope_credentials["validated_at"]})
+    return gradescope_token
+
+
+def refresh_gradescope_token(user: "UserContext", fernet: Fernet) -> str | None:
+    """
+    Logs in to Gradescope with a user's saved credentials (if available) and saves the new token. If this fails, the
+    user is marked as needing to relink their Gradescope account.
+
+    Args:
+        user: The user's data
+        fernet: The Fernet object to use to decrypt the credentials
+
+    Returns:
+        The user's new Gradescope token, or None if a token could not be obtained
+
+    Raises:
+        GradescopeUnavailableError: If Gradescope is down (in which case the user isn't marked as needing to relink)
+        CircuitOpenError: If Gradescope's circuit breaker is open
+    """
+    gradescope_credentials = user.credentials.setdefault("gradescope", {})
+
+    # Do we have credentials to log in to Gradescope?
+    gradescope_token = None
+    gradescope_email = gradescope_credentials.get("email", None)
+    gradescope_password = gradescope_credentials.get("password", None)
+    if gradescope_email and gradescope_password:
+        # If so, log in to Gradescope and get a new token
+        gradescope_token = login_to_gradescope(
+            fernet_decrypt(gradescope_email, fernet),
+            fernet_decrypt(gradescope_password, fernet)
+        )
+
+    # If we still don't have a token, the user needs to relink their Gradescope account
+    # (unless Gradescope is having problems, in which case the failure probably isn't the credentials' fault)
+    if not gradescope_token:
+        if not gradescope_circuit.healthy:
+            raise GradescopeUnavailableError("Could not log in to Gradescope while it seems to be down")
+        user.auth_status["gradescope"] = False
+        user.write({f'auth_status/{user.uid}/gradescope': False})
+        return None
 
-        # Save the new token
-        db.reference(f'credentials/{uid}/gradescope/token').set(fernet_encrypt(gradescope_token, fernet))
+    # Save the new token (A token we just logged in with is known to be valid)
+    updated_credentials = {
+        "token": fernet_encrypt(gradescope_token, fernet),
+        "validated_at": time.time()
+    }
+    gradescope_credentials.update(updated_credentials)
+    user.write({f'credentials/{user.uid}/gradescope/{key}': value for key, value in updated_credentials.items()})
 
     return gradescope_token
 
 
+def create_gradescope_connector(limit: int = 100, limit_per_host: int = 0, dns_cache_ttl: int = 10,
+                                keepalive_timeout: float = 15) -> aiohttp.TCPConnector:
+    """
+    Creates a connection pool which can be shared between the Gradescope sessions of many users, so that they reuse
+    warm (already resolved, connected, and TLS-negotiated) connections instead of each opening their own
+
+    Args:
+        limit: The maximum number of simultaneous connections in the pool (0 for no limit)
+        limit_per_host: The maximum number of simultaneous connections to a single host (0 for no limit)
+        dns_cache_ttl: The number of seconds to cache DNS lookups for
+        keepalive_timeout: The number of seconds to keep idle connections open for
+
+    Returns:
+        The connector (The caller is responsible for closing it)
+    """
+    return aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host, ttl_dns_cache=dns_cache_ttl,
+                                keepalive_timeout=keepalive_timeout)
+
+
 def format_gradescope_url(url: str) -> str:
     """
     Takes a href from a Gradescope page and formats it into a full URL
@@ -127,27 +619,101 @@ def format_gradescope_url(url: str) -> str:
     return f'https://www.gradescope.com{url if url.startswith("/") else f"/{url}"}'
 
 
-async def get_async_data_from_gradescope(url: str, query: str, session: aiohttp.ClientSession) \
-        -> list[etree.Element]:
+async def get_async_page_from_gradescope(url: str, session: aiohttp.ClientSession,
+                                         section: Optional[tuple[bytes, bytes]] = None,
+                                         max_redirects: int = 5) -> bytes:
     """
-    Downloads a Gradescope page asynchronously and parses it with XPath
+    Downloads a Gradescope page asynchronously
 
     Args:
         url: The URL of the Gradescope page to download
-        query: The XPath query to use to parse the page
         session: The aiohttp session to use to download the page
+        section: If given, only this section of the page is kept (see read_page_section)
+        max_redirects: The number of redirects (other than to the login page) to follow
 
     Returns:
-        The parsed elements
+        The contents of the page (or the section)
 
     Raises:
+        GradescopeAuthError: If Gradescope rejects the session's token
+        GradescopeUnavailableError: If Gradescope is down
+        GradescopeRateLimitError: If Gradescope is rate limiting requests
+        CircuitOpenError: If Gradescope's circuit breaker is open
         RuntimeError: If the request fails
     """
-    async with session.get(format_gradescope_url(url)) as response:
-        if response.status != 200:
-            raise RuntimeError(f"Gradescope Error: {response.status}! {await response.read()}")
+    # If the token is invalid, Gradescope redirects to the login page, so redirects are followed manually
+    # (Other redirects, ex. from a course the user has left to the course list, are followed like normal)
+    with gradescope_circuit.guard(GRADESCOPE_OUTAGE_ERRORS):
+        for _ in range(max_redirects + 1):
+            async with get_gradescope_rate_limiter().limit(GRADESCOPE_THROTTLE_ERRORS), \
+                    session.get(format_gradescope_url(url), allow_redirects=False) as response:
+                if response.status == 401:
+                    raise GradescopeAuthError(f"Gradescope rejected the token: {response.status}!")
+                if 300 <= response.status < 400:
+                    location = urllib.parse.urlsplit(response.headers.get("Location", ""))
+                    if location.path.rstrip("/") == "/login":
+                        raise GradescopeAuthError(f"Gradescope rejected the token: {response.status}!")
+                    if location.netloc not in ("", "www.gradescope.com") or not location.path:
+                        raise RuntimeError(f"Gradescope Error: {response.status}! Redirected to {location.geturl()}")
+                    url = f'{location.path}?{location.query}' if location.query else location.path
+                    continue
+                if response.status == 429:
+                    raise GradescopeRateLimitError(f"Gradescope Error: {response.status}!")
+                if response.status >= 500:
+                    raise GradescopeUnavailableError(f"Gradescope Error: {response.status}!")
+                if response.status != 200:
+                    raise RuntimeError(f"Gradescope Error: {response.status}! {await response.read()}")
+
+                if section is not None:
+                    return await read_page_section(response.content, *section)
+                return await response.read()
+
+    raise RuntimeError(f"Gradescope Error: Too many redirects for {url}!")
+
+
+async def read_page_section(stream: aiohttp.StreamReader, start_marker: bytes, end_marker: bytes,
+                            chunk_size: int = 64 * 1024) -> bytes:
+    """
+    Reads a section of an HTML page as it is downloaded, without keeping the rest of the page in memory
+    The section starts at the tag containing the first occurrence of start_marker, and ends after the following
+    occurrence of end_marker. Everything after the section is read (so that the connection can be reused) but discarded.
+
+    Args:
+        stream: The page's content stream
+        start_marker: Bytes which appear inside the section's opening tag (ex. its id attribute)
+        end_marker: Bytes which end the section (ex. its closing tag)
+        chunk_size: The number of bytes to read at a time
+
+    Returns:
+        The section (or an empty string if the page doesn't contain start_marker)
+    """
+    buffer = bytearray()
+    found_start = found_end = False
+    async for chunk in stream.iter_chunked(chunk_size):
+        if found_end:
+            continue  # Drain the rest of the page
+
+        if not found_start:
+            # (Start searching far enough back to catch a marker which was split between chunks)
+            search_from = max(len(buffer) - len(start_marker) + 1, 0)
+            buffer += chunk
+            if (marker_start := buffer.find(start_marker, search_from)) == -1:
+                # Only keep enough of the page to find the start of the opening tag once the marker arrives
+                del buffer[:max(len(buffer) - PAGE_SECTION_LOOKBEHIND, 0)]
+                continue
+            found_start = True
+            tag_start = buffer.rfind(b'<', 0, marker_start)
+            del buffer[:tag_start if tag_start != -1 else marker_start]
+            search_from = 0
+        else:
+            search_from = max(len(buffer) - len(end_marker) + 1, 0)
+            buffer += chunk
+
+        if (end := buffer.find(end_marker, search_from)) != -1:
+            found_end = True
+            del buffer[end + len(end_marker):]
 
-        return etree.HTML(await response.read(), None).findall(query)
+    return bytes(buffer) if found_start else b""
 
 
 def get_data_from_gradescope(url: str, query: str, gradescope_token: str) -> list[etree.Element]:
@@ -163,10 +729,20 @@ def get_data_from_gradescope(url: str, query: str, gradescope_token: str) -> lis
         The parsed elements
 
     Raises:
+        GradescopeAuthError: If Gradescope rejects the token
+        GradescopeUnavailableError: If Gradescope is down
+        CircuitOpenError: If Gradescope's circuit breaker is open
         RuntimeError: If the request fails
     """
     gradescope_cookies = {"signed_token": gradescope_token}
-    with requests.get(format_gradescope_url(url), cookies=gradescope_cookies) as response:
+    with gradescope_circuit.guard(GRADESCOPE_OUTAGE_ERRORS), \
+            requests.get(format_gradescope_url(url), cookies=gradescope_cookies,
+                         timeout=GRADESCOPE_REQUEST_TIMEOUT) as response:
+        # If the token is invalid, Gradescope redirects to the login page
+        if response.status_code == 401 or urllib.parse.urlsplit(response.url).path.rstrip("/") == "/login":
+            raise GradescopeAuthError(f"Gradescope rejected the token: {response.status_code}!")
+        if response.status_code >= 500:
+            raise GradescopeUnavailableError(f"Gradescope Error: {response.status_code}!")
         if response.status_code != 200:
             raise RuntimeError(f"Gradescope Error: {response.status_code}! {response.content}")
 
@@ -183,11 +759,25 @@ def login_to_gradescope(email: str, password: str) -> Optional[str]:
 
     Returns:
         The user's token or None if the login failed
+
+    Raises:
+        GradescopeUnavailableError: If Gradescope is down
+        CircuitOpenError: If Gradescope's circuit breaker is open
+    """
+    with gradescope_circuit.guard(GRADESCOPE_OUTAGE_ERRORS):
+        return _login_to_gradescope(email, password)
+
+
+def _login_to_gradescope(email: str, password: str) -> Optional[str]:
+    """
+    Logs in to Gradescope (see login_to_gradescope, which wraps this in Gradescope's circuit breaker)
     """
     # We first have to make a GET request to the login page to get an authenticity token
     # We use a session because Gradescope checks the authenticity token against a cookie to prevent CSRF attacks
     session = requests.Session()
-    with session.get("https://www.gradescope.com/login") as response:
+    with session.get("https://www.gradescope.com/login", timeout=GRADESCOPE_REQUEST_TIMEOUT) as response:
+        if response.status_code >= 500:
+            raise GradescopeUnavailableError(f"Gradescope Error: {response.status_code}!")
         if response.status_code != 200:
             return None
         # Extract the authenticity token from the login page
@@ -208,7 +798,10 @@ def login_to_gradescope(email: str, password: str) -> Optional[str]:
         "session[remember_me_sso]": "0",
     }
     # Try to log in to Gradescope
-    with (session.post("https://www.gradescope.com/login", data=form_data, allow_redirects=False) as response):
+    with (session.post("https://www.gradescope.com/login", data=form_data, allow_redirects=False,
+                       timeout=GRADESCOPE_REQUEST_TIMEOUT) as response):
+        if response.status_code >= 500:
+            raise GradescopeUnavailableError(f"Gradescope Error: {response.status_code}!")
         # If we're successfully logged in, we should be redirected to the account page
         if response.status_code != 302 or response.headers.get("location", '') != "https://www.gradescope.com/account":
             return None  # Invalid credentials
@@ -229,7 +822,7 @@ def logout_of_gradescope(token: str) -> None:
     """
     gradescope_cookies = {"signed_token": token}
     with requests.get(format_gradescope_url("/logout?tfs_mode=false"), cookies=gradescope_cookies,
-                      allow_redirects=False) as _response:
+                      allow_redirects=False, timeout=GRADESCOPE_REQUEST_TIMEOUT) as _response:
         pass  # Ignore the response
 
 
@@ -237,54 +830,157 @@ def logout_of_gradescope(token: str) -> None:
 
 # region Google
 
-def login_to_google(uid: str, oauth2_client_id: SecretParam, oauth2_client_secret: SecretParam, fernet: Fernet) -> Any:
+# The errors which indicate that Google is down (rather than that a request was bad)
+GOOGLE_OUTAGE_ERRORS = (TransportError, httplib2.HttpLib2Error, OSError)
+# Stops requests to Google while it is down (see CircuitBreaker)
+google_circuit = CircuitBreaker("Google")
+# The errors which mean that a request from a user can't be handled until Gradescope or Google recovers
+# (Retryable RefreshErrors are the only ones which escape login_to_google)
+SERVICE_OUTAGE_ERRORS = (CircuitOpenError, RefreshError) + GRADESCOPE_OUTAGE_ERRORS + GOOGLE_OUTAGE_ERRORS
+
+# Locks which prevent the same user's Google access token from being refreshed by multiple threads at once, and how
+# many threads are using each of them (Each lock is dropped once no thread is using it, see _google_login_lock)
+_google_login_locks: dict[str, tuple[threading.Lock, int]] = {}
+# The most recent access token (in the same form as it is cached in the database) this process got for each user
+# (Tokens are dropped once they are too close to expiring to be reused, see _cache_google_access_token)
+_google_access_tokens: dict[str, dict[str, str]] = {}
+# Guards _google_login_locks and _google_access_tokens
+_google_login_state_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _google_login_lock(uid: str) -> Iterator[None]:
+    """
+    Holds the lock which prevents a user's Google access token from being refreshed by multiple threads at once
+    """
+    with _google_login_state_lock:
+        lock, users = _google_login_locks.get(uid, (threading.Lock(), 0))
+        _google_login_locks[uid] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _google_login_state_lock:
+            lock, users = _google_login_locks[uid]
+            if users > 1:
+                _google_login_locks[uid] = (lock, users - 1)
+            else:
+                del _google_login_locks[uid]
+
+
+def _cache_google_access_token(uid: str, access_token: dict[str, str]) -> None:
+    """
+    Remembers the access token this process got for a user, and forgets the tokens which can no longer be reused
+    """
+    reuse_deadline = datetime.utcnow() + GOOGLE_ACCESS_TOKEN_EXPIRY_MARGIN
+    with _google_login_state_lock:
+        _google_access_tokens[uid] = access_token
+        for expired_uid in [cached_uid for cached_uid, cached_token in _google_access_tokens.items()
+                            if datetime.fromisoformat(cached_token["expiry"]) <= reuse_deadline]:
+            del _google_access_tokens[expired_uid]
+
+
+def login_to_google(user: "UserContext", oauth2_client_id: SecretParam, oauth2_client_secret: SecretParam,
+                    fernet: Fernet) -> Any:
     """
     Attempts to redeem a user's Google refresh token for an access token and returns the credentials if successful
+    If the user has a cached access token which is not close to expiring, that token is reused instead
 
     Args:
-        uid: The user's UID
+        user: The user's data
         oauth2_client_id: This app's Google OAuth2 client ID
         oauth2_client_secret: This app's Google OAuth2 client secret
         fernet: The Fernet object to use to decrypt the refresh token
 
     Returns:
         The user's Google credentials, or None if the login failed
+
+    Raises:
+        CircuitOpenError: If Google's circuit breaker is open
     """
     # Has the user linked their Google account?
-    if not db.reference(f'auth_status/{uid}/google').get():
+    if not user.auth_status.get("google", False):
         return None
 
-    # Get the user's refresh token
-    if not (refresh_token := get_db_ref_as_type(f'credentials/{uid}/google/token', str)):
-        db.reference(f'auth_status/{uid}/google').set(False)
-        return None
+    # If another thread is already logging this user in, wait for it to finish, so we can reuse the token it gets
+    with _google_login_lock(user.uid):
+        google_credentials = user.credentials.setdefault("google", {})
 
-    # Decrypt the refresh token
-    refresh_token = fernet_decrypt(refresh_token, fernet)
-
-    # Create a Credentials object from the refresh token
-    credentials = Credentials(
-        token=None,
-        refresh_token=refresh_token,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=oauth2_client_id.value,
-        client_secret=oauth2_client_secret.value,
-        scopes=GOOGLE_API_SCOPES
-    )
-    try:
-        # Attempt to redeem the refresh token for an access token
-        credentials.refresh(Request())
-    except RefreshError:
-        db.reference(f'auth_status/{uid}/google').set(False)
-        return None
+        # Get the user's refresh token
+        if not (refresh_token := google_credentials.get("token", None)):
+            user.auth_status["google"] = False
+            user.write({f'auth_status/{user.uid}/google': False})
+            return None
+
+        # Decrypt the refresh token
+        refresh_token = fernet_decrypt(refresh_token, fernet)
+
+        # Create a Credentials object from the refresh token
+        credentials = Credentials(
+            token=None,
+            refresh_token=refresh_token,
+            token_uri="https://oauth2.googleapis.com/token",
+            client_id=oauth2_client_id.value,
+            client_secret=oauth2_client_secret.value,
+            scopes=GOOGLE_API_SCOPES
+        )
+
+        # If we have a cached access token that isn't about to expire, use it
+        # (Check both the database's cache and this process's, in case another thread just refreshed the token)
+        cached_access_tokens = [access_token
+                                for access_token in (google_credentials.get("access_token", None),
+                                                     _google_access_tokens.get(user.uid, None))
+                                if access_token]
+        if cached_access_tokens:
+            cached_access_token = max(cached_access_tokens,
+                                      key=lambda access_token: datetime.fromisoformat(access_token["expiry"]))
+            expiry = datetime.fromisoformat(cached_access_token["expiry"])
+            if expiry - GOOGLE_ACCESS_TOKEN_EXPIRY_MARGIN > datetime.utcnow():
+                credentials.token = fernet_decrypt(cached_access_token["token"], fernet)
+                credentials.expiry = expiry
+                return credentials
+
+        try:
+            # Attempt to redeem the refresh token for an access token
+            with google_circuit.guard(GOOGLE_OUTAGE_ERRORS):
+                credentials.refresh(Request())
+        except RefreshError as e:
+            # Only mark the user as needing to relink their account if Google actually rejected the refresh token
+            if getattr(e, "retryable", False) or not google_circuit.healthy:
+                raise
+            user.auth_status["google"] = False
+            user.write({f'auth_status/{user.uid}/google': False})
+            return None
 
-    # Save the new refresh token if it has changed
-    if credentials.refresh_token != refresh_token:
-        db.reference(f'credentials/{uid}/google/token').set(fernet_encrypt(credentials.refresh_token, fernet))
+        # Cache the new access token
+        updated_credentials = {"access_token": encrypt_google_access_token(credentials, fernet)}
+        _cache_google_access_token(user.uid, updated_credentials["access_token"])
+        # Save the new refresh token if it has changed
+        if credentials.refresh_token != refresh_token:
+            updated_credentials["token"] = fernet_encrypt(credentials.refresh_token, fernet)
+        google_credentials.update(updated_credentials)
+        user.write({f'credentials/{user.uid}/google/{key}': value for key, value in updated_credentials.items()})
 
     return credentials
 
 
+def encrypt_google_access_token(credentials: Any, fernet: Fernet) -> dict[str, str]:
+    """
+    Encrypts a Google access token so that it can be cached in the database
+
+    Args:
+        credentials: The Google credentials containing the access token
+        fernet: The Fernet object to use to encrypt the access token
+
+    Returns:
+        The access token and its expiry (as a naive UTC ISO datetime) in a dictionary
+    """
+    return {
+        "token": fernet_encrypt(credentials.token, fernet),
+        "expiry": credentials.expiry.isoformat()
+    }
+
+
 def logout_of_google(token: str) -> None:
     """
     Logs a user out of Google by attempting to invalidate their token
@@ -305,98 +1001,368 @@ def logout_of_google(token: str) -> None:
         pass  # Ignore the response
 
 
-def create_assignment_event(calendar_service: Any, event_create_batch: Any, calendar_id: str, course: Course,
-                            assignment: Assignment, completed_color: str | None,
-                            callback: Callable[[Any, Any, Any], Any]) -> None:
+def create_assignment_event(calendar_service: Any, calendar_id: str, uid: str, course: Course, assignment_id: str,
+                            assignment: "AssignmentRecord", completed_color: str | None) -> Any | None:
     """
-    Creates a Google Calendar event for an assignment
+    Builds a request to create a Google Calendar event for an assignment
 
     Args:
         calendar_service: The Google Calendar service
-        event_create_batch: The batch to add the event creation request to
         calendar_id: The ID of the calendar to create the event in
+        uid: The UID of the user the event is for (which the event is tagged with, see ASSIGNMENT_EVENT_OWNER_PROPERTY)
         course: The course the assignment is for
+        assignment_id: The ID of the assignment (which the event is tagged with, see ASSIGNMENT_EVENT_PROPERTY)
         assignment: The assignment to create the event for
         completed_color: The color to use for completed assignments
-        callback: The callback to pass to the batch to call when the event is created
 
     Returns:
-        None
+        The request (to be executed with execute_calendar_requests), or None if an event can't be created
     """
-    # Check that the associated course has enough information to create an event
-    if not validate_object_with_keys(course, "name", "color", "href"):
-        return
-
     # Create the event object
-    event = {
-        "summary": f'{assignment["name"]} [{assignment["course_id"]}]',
-        "description": f'Assignment for <a href="{format_gradescope_url(course["href"])}">{course["name"]}</a> on '
-                       f'Gradescope',
-        "start": {
-            "dateTime": assignment["due_date"]
-        },
-        "end": {
-            "dateTime": assignment["due_date"]
-        },
-        "colorId": completed_color if completed_color and assignment["completed"] else course["color"],
-    }
-    # Add a request to create the event to the batch
-    event_create_batch.add(calendar_service.events().insert(calendarId=calendar_id, body=event), callback=callback)
+    if (event := build_assignment_event(course, assignment, completed_color)) is None:
+        return None
+    event["description"] = (f'Assignment for <a href="{format_gradescope_url(course["href"])}">{course["name"]}</a> '
+                            f'on Gradescope')
+    # Tag the event, so that it can be recognized when the calendar is reconciled with the cache
+    event["extendedProperties"] = {"private": {ASSIGNMENT_EVENT_PROPERTY: assignment_id,
+                                               ASSIGNMENT_EVENT_OWNER_PROPERTY: uid}}
+    return calendar_service.events().insert(calendarId=calendar_id, body=event)
 
 
-def patch_assignment_event(calendar_service: Any, event_update_batch: Any, calendar_id: str, course: Course,
-                           assignment: Assignment, completed_color: str | None) -> None:
+def patch_assignment_event(calendar_service: Any, calendar_id: str, course: Course, assignment: "AssignmentRecord",
+                           completed_color: str | None) -> Any | None:
     """
-    Patches a Google Calendar event for an assignment with updated information
+    Builds a request to patch a Google Calendar event for an assignment with updated information
 
     Args:
         calendar_service: The Google Calendar service
-        event_update_batch: The batch to add the event patch request to
         calendar_id: The ID of the calendar to patch the event in
         course: The course the assignment is for
         assignment: The assignment to patch the event for
         completed_color: The color to use for completed assignments
 
     Returns:
-        None
+        The request (to be executed with execute_calendar_requests), or None if the event can't be patched
+    """
+    # Create the event object
+    if (event := build_assignment_event(course, assignment, completed_color)) is None:
+        return None
+    return calendar_service.events().patch(calendarId=calendar_id, eventId=assignment.event_id, body=event)
+
+
+def delete_assignment_event(calendar_service: Any, calendar_id: str, event_id: str) -> Any:
+    """
+    Builds a request to delete an assignment's Google Calendar event
+
+    Args:
+        calendar_service: The Google Calendar service
+        calendar_id: The ID of the calendar to delete the event from
+        event_id: The ID of the event
+
+    Returns:
+        The request (to be executed with execute_calendar_requests)
+    """
+    return calendar_service.events().delete(calendarId=calendar_id, eventId=event_id)
+
+
+def build_assignment_event(course: Course, assignment: "AssignmentRecord", completed_color: str | None) \
+        -> dict[str, Any] | None:
     """
-    # Check that the associated course has enough information to patch an event
+    Builds the parts of an assignment's Google Calendar event which are kept up to date (the body of a patch request)
+
+    Args:
+        course: The course the assignment is for
+        assignment: The assignment to build the event for
+        completed_color: The color to use for completed assignments
+
+    Returns:
+        The event, or None if the course doesn't have enough information to create an event
+    """
+    # Check that the associated course has enough information to create an event
     if not validate_object_with_keys(course, "name", "color", "href"):
-        return
+        return None
 
-    # Create the event object
-    event = {
-        "summary": f'{assignment["name"]} [{assignment["course_id"]}]',
+    return {
+        "summary": f'{assignment.name} [{assignment.course_id}]',
         "start": {
-            "dateTime": assignment["due_date"]
+            "dateTime": assignment.due_date
         },
         "end": {
-            "dateTime": assignment["due_date"]
+            "dateTime": assignment.due_date
         },
-        "colorId": completed_color if completed_color and assignment["completed"] else course["color"],
+        "colorId": completed_color if completed_color and assignment.completed else course["color"],
     }
-    # Add a request to patch the event to the batch
-    event_update_batch.add(calendar_service.events().patch(calendarId=calendar_id, eventId=assignment["event_id"],
-                                                           body=event))
+
+
+def get_assignment_event_hash(course: Course, assignment: "AssignmentRecord", completed_color: str | None) \
+        -> str | None:
+    """
+    Computes a hash of an assignment's event (see build_assignment_event), so that the event only needs to be patched
+    when the hash is different from the one stored with the assignment
+
+    Args:
+        course: The course the assignment is for
+        assignment: The assignment to hash the event of
+        completed_color: The color to use for completed assignments
+
+    Returns:
+        The hash, or None if the course doesn't have enough information to create an event
+    """
+    if (event := build_assignment_event(course, assignment, completed_color)) is None:
+        return None
+    return hashlib.blake2b(json.dumps(event, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+def assignment_event_matches(event: dict[str, Any], expected_event: dict[str, Any]) -> bool:
+    """
+    Checks whether an event in a user's calendar still has the contents it should have (see build_assignment_event), or
+    whether it has been changed (e.g. moved) since it was last updated
+
+    Args:
+        event: The event as it is in the calendar
+        expected_event: The event as it should be
+
+    Returns:
+        True if the event matches, False otherwise
+    """
+    def same_time(time: dict[str, str] | None, expected_time: dict[str, str]) -> bool:
+        # Google may return the time in the calendar's time zone, so compare the times rather than the strings
+        try:
+            return datetime.fromisoformat(time["dateTime"]) == datetime.fromisoformat(expected_time["dateTime"])
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    return (event.get("summary", None) == expected_event["summary"] and
+            event.get("colorId", None) == expected_event["colorId"] and
+            same_time(event.get("start", None), expected_event["start"]) and
+            same_time(event.get("end", None), expected_event["end"]))
+
+
+def get_assignment_event_tag(event: dict[str, Any], uid: str) -> str | None:
+    """
+    Gets the ID of the assignment an event was created for (see ASSIGNMENT_EVENT_PROPERTY), if it was created for a user
+
+    Args:
+        event: The event
+        uid: The UID of the user (see ASSIGNMENT_EVENT_OWNER_PROPERTY)
+
+    Returns:
+        The assignment ID, or None if the event wasn't created by this app for the user (or was created before events
+        were tagged)
+    """
+    tags = event.get("extendedProperties", {}).get("private", {})
+    if tags.get(ASSIGNMENT_EVENT_OWNER_PROPERTY, None) != uid:
+        return None
+    return tags.get(ASSIGNMENT_EVENT_PROPERTY, None)
+
+
+class CalendarSyncTokenExpiredError(Exception):
+    """
+    Raised when Google no longer accepts a calendar's sync token, so the calendar has to be listed from scratch
+    """
+    pass
+
+
+def list_changed_calendar_events(calendar_service: Any, calendar_id: str, sync_token: str | None,
+                                 page_size: int = 2500) -> tuple[list[dict[str, Any]], str | None]:
+    """
+    Lists the events in a calendar which have changed (including events which have been deleted) since a sync token was
+    issued, or every event in the calendar if there is no sync token
+
+    Args:
+        calendar_service: The Google Calendar service
+        calendar_id: The ID of the calendar
+        sync_token: The sync token from the last time the calendar was listed (or None to list every event)
+        page_size: The number of events to request at a time
+
+    Returns:
+        The events (with only the fields in CALENDAR_SYNC_FIELDS), and the sync token to list the events which change
+        after this
+
+    Raises:
+        CalendarSyncTokenExpiredError: If the sync token has expired
+        CircuitOpenError: If Google is down
+        HttpError: If a request fails
+    """
+    events = []
+    page_token = None
+    while True:
+        # (The events can't be filtered by their extended properties here, since Google doesn't allow filters with sync
+        # tokens)
+        request = calendar_service.events().list(calendarId=calendar_id, syncToken=sync_token, pageToken=page_token,
+                                                 maxResults=page_size, fields=CALENDAR_SYNC_FIELDS)
+        try:
+            with google_circuit.guard(GOOGLE_OUTAGE_ERRORS):
+                response = request.execute()
+        except HttpError as e:
+            if e.status_code == 410:
+                raise CalendarSyncTokenExpiredError(f"The sync token for calendar {calendar_id} has expired") from e
+            raise
+
+        events.extend(response.get("items", []))
+        if not (page_token := response.get("nextPageToken", None)):
+            return events, response.get("nextSyncToken", None)
+
+
+async def execute_calendar_requests(calendar_service: Any, calendar_requests: dict[str, Any],
+                                    max_concurrency: int = 4, max_retries: int = 5, initial_backoff: float = 1) \
+        -> dict[str, CalendarRequestOutcome]:
+    """
+    Executes Google Calendar API requests in batches of at most GOOGLE_CALENDAR_BATCH_LIMIT requests. The batches are
+    executed concurrently, and requests which fail with a transient error (rate limiting, server errors, dropped
+    connections) are retried with exponential backoff.
+
+    Args:
+        calendar_service: The Google Calendar service the requests were built with
+        calendar_requests: The requests to execute, keyed by an ID for each request
+        max_concurrency: The maximum number of batches to execute at the same time
+        max_retries: The maximum number of times to retry a failed request
+        initial_backoff: The number of seconds to wait before the first retry (This doubles for each retry)
+
+    Returns:
+        The outcome of each request as a (response, exception) tuple, keyed by the request's ID
+    """
+    outcomes = {}
+    pending_requests = calendar_requests
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def execute_batch(batch_requests: dict[str, Any]) -> dict[str, CalendarRequestOutcome]:
+        async with semaphore:
+            return await run_blocking(execute_calendar_request_batch, calendar_service, batch_requests)
+
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            # Back off (with some jitter, so that retries from different users don't line up)
+            await asyncio.sleep(initial_backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5))
+
+        # Split the requests into batches that Google will accept
+        pending_items = list(pending_requests.items())
+        batches = [dict(pending_items[i:i + GOOGLE_CALENDAR_BATCH_LIMIT])
+                   for i in range(0, len(pending_items), GOOGLE_CALENDAR_BATCH_LIMIT)]
+
+        # Only retry the requests that failed transiently
+        pending_requests = {}
+        for batch_outcomes in await asyncio.gather(*(execute_batch(batch) for batch in batches)):
+            for request_id, (response, exception) in batch_outcomes.items():
+                if is_retryable_calendar_error(exception) and attempt < max_retries:
+                    pending_requests[request_id] = calendar_requests[request_id]
+                else:
+                    outcomes[request_id] = (response, exception)
+
+        if not pending_requests:
+            break
+
+    return outcomes
+
+
+def execute_calendar_request_batch(calendar_service: Any, calendar_requests: dict[str, Any]) \
+        -> dict[str, CalendarRequestOutcome]:
+    """
+    Executes a single batch of Google Calendar API requests (This blocks, and is safe to run on any thread)
+
+    Args:
+        calendar_service: The Google Calendar service the requests were built with
+        calendar_requests: The requests to execute, keyed by an ID for each request
+
+    Returns:
+        The outcome of each request as a (response, exception) tuple, keyed by the request's ID
+    """
+    outcomes = {}
+
+    # If Google is down, don't send the batch
+    try:
+        google_circuit.before_request()
+    except CircuitOpenError as e:
+        return {request_id: (None, e) for request_id in calendar_requests}
+
+    def record_outcome(request_id, response, exception):
+        outcomes[request_id] = (response, exception)
+
+    batch = calendar_service.new_batch_http_request(callback=record_outcome)
+    for request_id, request in calendar_requests.items():
+        batch.add(request, request_id=request_id)
+
+    # httplib2 connections can't be shared between threads, so give each batch its own connection
+    credentials = getattr(next(iter(calendar_requests.values())).http, "credentials", None)
+    http = build_http() if credentials is None else AuthorizedHttp(credentials, http=build_http())
+
+    try:
+        batch.execute(http=http)
+    except Exception as e:
+        # If the batch as a whole failed, so did every request in it which doesn't have an outcome yet
+        for request_id in calendar_requests:
+            outcomes.setdefault(request_id, (None, e))
+
+    # Let Google's circuit breaker know whether Google is up (Individual requests failing with server errors count
+    # against it, but rate limiting doesn't)
+    if any(isinstance(exception, GOOGLE_OUTAGE_ERRORS) or
+           (isinstance(exception, HttpError) and exception.status_code >= 500)
+           for _response, exception in outcomes.values()):
+        google_circuit.record_failure()
+    else:
+        google_circuit.record_success()
+
+    return outcomes
+
+
+def get_http_error_reasons(exception: HttpError) -> set[str]:
+    """
+    Gets the machine-readable reasons (ex. "rateLimitExceeded") given in a Google API error response
+    """
+    if not isinstance(exception.error_details, list):
+        return set()
+    return {detail.get("reason", "") for detail in exception.error_details if isinstance(detail, dict)}
+
+
+def is_rate_limit_error(exception: Exception | None) -> bool:
+    """
+    Checks if an exception from a Google API indicates that the request was rate limited
+    """
+    if not isinstance(exception, HttpError):
+        return False
+    return exception.status_code == 429 or (
+            exception.status_code == 403 and
+            bool(get_http_error_reasons(exception) & {"rateLimitExceeded", "userRateLimitExceeded"}))
+
+
+def is_retryable_calendar_error(exception: Exception | None) -> bool:
+    """
+    Checks if an exception from the Google Calendar API is transient, meaning that the request should be retried
+    """
+    if isinstance(exception, HttpError):
+        return exception.status_code >= 500 or is_rate_limit_error(exception)
+    # Transport errors (dropped connections, timeouts, etc.)
+    return isinstance(exception, (httplib2.HttpLib2Error, OSError))
+
+
+# Function URLs which have already been looked up by this instance, keyed by (name, location), with the time they were
+# looked up
+_function_urls: dict[tuple[str, str], tuple[str, float]] = {}
 
 
 # Modified from:
 #   https://github.com/firebase/functions-samples/blob/071ac156f63dbc4fcef5adc492d912c51949978c/Python/taskqueues-backup-images/functions/main.py#L121-L140
-def get_function_url(name: str, location: str = SupportedRegion.US_CENTRAL1) -> str:
+def get_function_url(name: str, location: str = SupportedRegion.US_CENTRAL1, ttl: float = 0) -> str:
     """Get the URL of a given v2 cloud function.
 
     Params:
         name: the function's name
         location: the function's location
+        ttl: the number of seconds to reuse a URL looked up by an earlier call for (so that warm instances don't look it
+             up on every invocation)
 
     Returns: The URL of the function
     """
+    if (cached_url := _function_urls.get((name, location), None)) is not None and time.time() - cached_url[1] < ttl:
+        return cached_url[0]
+
     credentials, project_id = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
     authed_session = AuthorizedSession(credentials)
     url = f'https://cloudfunctions.googleapis.com/v2/projects/{project_id}/locations/{location}/functions/{name}'
     response = authed_session.get(url)
     data = response.json()
     function_url = data["serviceConfig"]["uri"]
+    _function_urls[(name, location)] = (function_url, time.time())
     return function_url
 
 
@@ -404,6 +1370,164 @@ def get_function_url(name: str, location: str = SupportedRegion.US_CENTRAL1) ->
 
 # region Firebase
 
+# The trees in the database which store data for each user (keyed by UID)
+USER_DATA_TREES = ("assignments", "auth_status", "cache", "credentials", "settings", "sync_state")
+
+
+class UserContext:
+    """
+    A user's data from each of the per-user trees in the database (see USER_DATA_TREES)
+    Each tree is read from the database the first time it is used, unless it was prefetched (see
+    prefetch_user_contexts). Code which writes to the user's data should do so through write and should also update the
+    context, so that the context stays consistent with the database.
+    """
+
+    def __init__(self, uid: str, write_buffer: Optional["DatabaseWriteBuffer"] = None, **prefetched_trees: Any):
+        self.uid = uid
+        self.write_buffer = write_buffer
+        self._trees = prefetched_trees
+
+    def write(self, updates: dict[str, Any]) -> None:
+        """
+        Writes a multi-path update (mapping paths from the root of the database to their new values) to the database,
+        or adds it to the context's write buffer if it has one
+        """
+        if not updates:
+            return
+        if self.write_buffer is not None:
+            self.write_buffer.update(updates)
+        else:
+            db.reference().update(updates)
+
+    def _get_tree(self, tree: str) -> dict[str, Any]:
+        if tree not in self._trees:
+            self._trees[tree] = db.reference(f'{tree}/{self.uid}').get()
+        # Trees which don't exist are replaced with empty dictionaries, so that they can be updated in place
+        if not isinstance(self._trees[tree], dict):
+            self._trees[tree] = {}
+        return self._trees[tree]
+
+    @property
+    def assignments(self) -> "AssignmentCache":
+        # The assignments are converted to records the first time they are used
+        if not isinstance(assignments := self._get_tree("assignments"), AssignmentCache):
+            assignments = self._trees["assignments"] = AssignmentCache.from_db(assignments)
+        return assignments
+
+    @assignments.setter
+    def assignments(self, assignments: "AssignmentCache") -> None:
+        self._trees["assignments"] = assignments
+
+    @property
+    def auth_status(self) -> dict[str, bool]:
+        return self._get_tree("auth_status")
+
+    @property
+    def cache(self) -> dict[str, Any]:
+        return self._get_tree("cache")
+
+    @property
+    def credentials(self) -> dict[str, Any]:
+        return self._get_tree("credentials")
+
+    @property
+    def settings(self) -> UserSettings:
+        return self._get_tree("settings")
+
+    @property
+    def sync_state(self) -> dict[str, Any]:
+        return self._get_tree("sync_state")
+
+
+async def prefetch_user_contexts(uids: list[str], write_buffer: Optional["DatabaseWriteBuffer"] = None) \
+        -> dict[str, UserContext]:
+    """
+    Reads all the data for a group of users from the database
+    The small "sync_state" tree (which every user who has been synced has) is read for the range of keys from the first
+    to the last user, to find the runs of users which are next to each other in key order. Each other tree is then read
+    with a single query per run, so that the data of the users between the runs (which aren't in the group) isn't read.
+
+    Args:
+        uids: The UIDs of the users to read
+        write_buffer: The buffer to collect the users' writes in (If this is None, writes are sent immediately)
+
+    Returns:
+        A context containing each user's data, keyed by UID
+    """
+    if not uids:
+        return {}
+
+    uids = sorted(set(uids), key=db_key_order)
+    sync_states = await run_blocking(get_db_key_range, "sync_state", uids[0], uids[-1])
+
+    # Split the users wherever a user who isn't in the group comes between them
+    included_uids = set(uids)
+    runs: list[list[str]] = []
+    continues_run = False
+    for uid in sorted(sync_states.keys() | included_uids, key=db_key_order):
+        if uid in included_uids:
+            if not continues_run:
+                runs.append([])
+            runs[-1].append(uid)
+        continues_run = uid in included_uids
+
+    other_trees = [tree for tree in USER_DATA_TREES if tree != "sync_state"]
+    run_data = await asyncio.gather(*(run_blocking(get_db_key_range, tree, run[0], run[-1])
+                                      for tree in other_trees for run in runs))
+    trees = {"sync_state": sync_states}
+    for i, tree in enumerate(other_trees):
+        trees[tree] = {uid: data for run_tree_data in run_data[i * len(runs):(i + 1) * len(runs)]
+                       for uid, data in run_tree_data.items()}
+
+    return {uid: UserContext(uid, write_buffer, **{tree: trees[tree].get(uid, None) for tree in USER_DATA_TREES})
+            for uid in uids}
+
+
+def get_db_key_range(path: str, start_key: str, end_key: str) -> dict[str, Any]:
+    """
+    Gets the children of a reference from the Firebase database whose keys are between two keys (inclusive)
+
+    Args:
+        path: The path to the reference
+        start_key: The first key to include
+        end_key: The last key to include
+
+    Returns:
+        The matching children, keyed by their keys
+    """
+    return db.reference(path).order_by_key().start_at(start_key).end_at(end_key).get() or {}
+
+
+def db_key_order(key: str) -> tuple[int, int, str]:
+    """
+    A sort key which orders keys the same way as the database does when ordering by key
+    (Keys which are 32-bit integers come first, in numeric order, followed by all other keys, in lexicographic order)
+    """
+    if re.fullmatch(r'-?(0|[1-9]\d*)', key) and -2 ** 31 <= int(key) < 2 ** 31:
+        return 0, int(key), ""
+    return 1, 0, key
+
+
+# The characters used in Firebase Auth UIDs, in the order the database sorts them
+DB_KEY_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+
+def db_key_fraction(key: str, precision: int = 6) -> float:
+    """
+    Maps a key to a number in [0, 1) which increases with the key's position in the database's key order
+    Random keys made from DB_KEY_ALPHABET (like Firebase Auth UIDs) are spread evenly over the range. Keys which are
+    integers (which the database sorts first) map to 0.
+    """
+    if db_key_order(key)[0] == 0:
+        return 0
+    fraction, scale = 0, 1
+    for char in key[:precision]:
+        scale /= len(DB_KEY_ALPHABET)
+        # Characters outside the alphabet are mapped to the position they would be sorted into
+        fraction += bisect.bisect_left(DB_KEY_ALPHABET, char) * scale
+    return min(fraction, 1 - scale)
+
+
 def get_db_ref_as_type(path: str, datatype: Type[T], **kwargs) -> T:
     """
     Gets a reference from the Firebase database, retrieves its value, and casts it to the given type
@@ -419,6 +1543,127 @@ def get_db_ref_as_type(path: str, datatype: Type[T], **kwargs) -> T:
     return cast(datatype, db.reference(path).get(**kwargs))
 
 
+def get_db_delta(path: str, old: Any, new: Any) -> dict[str, Any]:
+    """
+    Computes the smallest multi-path update which changes the value at a path in the database from old to new
+
+    Args:
+        path: The path of the value
+        old: The value currently stored at the path (as it was read from the database)
+        new: The value that should be stored at the path
+
+    Returns:
+        A dictionary mapping each path which needs to change to its new value (or None if it should be deleted), which
+        can be passed to the root reference's update method
+    """
+    # The database doesn't store empty objects, so they are the same as no value at all
+    old = None if old == {} else old
+    new = None if new == {} else new
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        delta = {}
+        for key in old.keys() | new.keys():
+            delta.update(get_db_delta(f'{path}/{key}', old.get(key, None), new.get(key, None)))
+        return delta
+
+    return {} if old == new else {path: new}
+
+
+class DatabaseWriteBuffer:
+    """
+    Collects writes to the database, so that they can be sent together as a few multi-path updates instead of one
+    request per write. Writes are only sent when flush is called. Since flushing blocks, the buffer's owner should call
+    flush from an executor whenever is_due says that enough writes have been collected or the oldest of them has been
+    waiting for too long (adding writes never blocks, so it is safe to do from the event loop).
+    """
+
+    def __init__(self, max_size: int = 500, max_delay: float = 30):
+        """
+        Args:
+            max_size: The number of paths to collect before the buffer is due to be flushed
+            max_delay: The number of seconds a write can wait before the buffer is due to be flushed
+        """
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._updates: dict[str, Any] = {}
+        self._oldest_update_time = 0
+        self._lock = threading.Lock()
+
+    def update(self, updates: dict[str, Any]) -> None:
+        """
+        Adds a multi-path update (mapping paths from the root of the database to their new values) to the buffer
+        """
+        with self._lock:
+            if not self._updates:
+                self._oldest_update_time = time.time()
+            for path, value in updates.items():
+                self._add(path.strip("/"), value)
+
+    def is_due(self) -> bool:
+        """
+        Checks whether the buffer should be flushed, because enough writes have been collected or the oldest of them has
+        been waiting for too long
+        """
+        with self._lock:
+            return bool(self._updates) and (len(self._updates) >= self.max_size or
+                                            time.time() - self._oldest_update_time >= self.max_delay)
+
+    def _add(self, path: str, value: Any) -> None:
+        # The database rejects multi-path updates where one path is inside another, so merge overlapping paths
+        # If the path is inside one that is already being written, change the value being written to that path instead
+        segments = path.split("/")
+        for i in range(1, len(segments)):
+            if (ancestor := "/".join(segments[:i])) in self._updates:
+                ancestor_value = self._updates[ancestor]
+                if not isinstance(ancestor_value, dict):
+                    ancestor_value = self._updates[ancestor] = {}
+                for segment in segments[i:-1]:
+                    if not isinstance(ancestor_value.get(segment, None), dict):
+                        ancestor_value[segment] = {}
+                    ancestor_value = ancestor_value[segment]
+                ancestor_value[segments[-1]] = copy.deepcopy(value)
+                return
+
+        # Otherwise, this path replaces any paths inside it
+        for other_path in [other_path for other_path in self._updates if other_path.startswith(f'{path}/')]:
+            del self._updates[other_path]
+        self._updates[path] = copy.deepcopy(value)
+
+    def flush(self) -> set[str]:
+        """
+        Sends all the collected writes to the database
+        If the combined update fails, the writes are retried separately for each user, so that one user's bad write
+        doesn't prevent everyone else's from being saved
+
+        Returns:
+            The UIDs of the users whose writes could not be saved
+        """
+        with self._lock:
+            updates, self._updates = self._updates, {}
+        if not updates:
+            return set()
+
+        try:
+            db.reference().update(updates)
+            return set()
+        except Exception as e:
+            print(f"Failed to flush {len(updates)} writes together, retrying them for each user: {e}")
+
+        # Per-user paths look like <tree>/<uid>/...
+        updates_by_user = collections.defaultdict(dict)
+        for path, value in updates.items():
+            updates_by_user[path.split("/")[1] if "/" in path else path][path] = value
+
+        failed_users = set()
+        for uid, user_updates in updates_by_user.items():
+            try:
+                db.reference().update(user_updates)
+            except Exception as e:
+                print(f"Failed to save the writes for {uid}: {e}")
+                failed_users.add(uid)
+        return failed_users
+
+
 def fn_response(data: str | dict, code: FunctionsErrorCode = FunctionsErrorCode.OK) -> CallableFunctionResponse:
     """
     Formats a response to a Firebase callable function
@@ -449,6 +1694,144 @@ def fn_response(data: str | dict, code: FunctionsErrorCode = FunctionsErrorCode.
 # region Assignments
 
 
+# The section of a course page which contains its assignments table (see read_page_section)
+COURSE_PAGE_ASSIGNMENTS_SECTION = (b'id="assignments-student-table"', b'</table>')
+# The number of bytes of the assignments table to parse at a time
+COURSE_PAGE_PARSE_CHUNK_SIZE = 16 * 1024
+
+# The executors which course pages are parsed in, by kind and size (see get_parse_executor)
+_parse_executors: dict[tuple[str, int], concurrent.futures.Executor] = {}
+
+# Precompiled queries for the parts of a row (an assignment) in a course page's assignments table
+# The button or link to the assignment (in the first cell)
+ASSIGNMENT_LINK_QUERY = etree.XPath("./*[1]/*[1]")
+# The cell with the assignment's name
+ASSIGNMENT_NAME_QUERY = etree.XPath("./th[1]")
+# The contents of the submission status cell
+ASSIGNMENT_STATUS_QUERY = etree.XPath("./*[2]/*")
+# The progress bar (If the assignment is past due or does not have a due date, Gradescope will not include one)
+ASSIGNMENT_PROGRESS_QUERY = etree.XPath("./*[3]/*[1][count(*) > 1]")
+# The due date (relative to the progress bar)
+ASSIGNMENT_DUE_DATE_QUERY = etree.XPath("./*[3]/time[2]/@datetime")
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class AssignmentRecord:
+    """
+    An assignment in a user's assignment cache
+    Records are immutable, so caches can share them instead of copying them (use dataclasses.replace to change one).
+    """
+    name: str = dataclasses.field(compare=False)
+    # The due date in ISO format
+    due_date: str = dataclasses.field(compare=False)
+    completed: bool = dataclasses.field(compare=False)
+    course_id: str
+    # The ID of the assignment's event in the user's calendar (or "" if it doesn't have one yet)
+    event_id: str = ""
+    # Whether the assignment has changed since its event was last updated
+    outdated: bool = False
+    # The hash of the event as it was last sent to Google (see get_assignment_event_hash)
+    event_hash: str = ""
+    # The parts of the assignment which come from Gradescope, so that records can be compared without comparing each
+    # field (This stands in for name, due_date, and completed when records are compared)
+    content_key: tuple[str, str, bool] = dataclasses.field(init=False, repr=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "content_key", (self.name, self.due_date, self.completed))
+
+    def get_due_datetime(self) -> Optional[datetime]:
+        """
+        Parses the assignment's due date
+
+        Returns:
+            The due date (in UTC if it doesn't have a timezone), or None if the assignment doesn't have one
+        """
+        if not self.due_date:
+            return None
+        due_date = datetime.fromisoformat(self.due_date)
+        return due_date if due_date.tzinfo is not None else due_date.replace(tzinfo=timezone.utc)
+
+    @classmethod
+    def from_db(cls, value: Any) -> Optional["AssignmentRecord"]:
+        """
+        Creates a record from an assignment as it is stored in the database
+
+        Args:
+            value: The stored assignment
+
+        Returns:
+            The record, or None if the value isn't an assignment
+        """
+        if not isinstance(value, dict) or "course_id" not in value:
+            return None
+        return cls(name=value.get("name", ""), due_date=value.get("due_date", ""),
+                   completed=value.get("completed", False), course_id=value["course_id"],
+                   event_id=value.get("event_id", ""), outdated=value.get("outdated", False),
+                   event_hash=value.get("event_hash", ""))
+
+    def to_db(self) -> dict[str, Any]:
+        """
+        Converts the record to the form it is stored in the database
+
+        Returns:
+            The assignment as a dictionary
+        """
+        return {"name": self.name, "due_date": self.due_date, "completed": self.completed,
+                "course_id": self.course_id, "event_id": self.event_id, "outdated": self.outdated,
+                "event_hash": self.event_hash}
+
+
+class AssignmentCache(dict[str, AssignmentRecord]):
+    """
+    A user's assignment cache, mapping assignment IDs to assignment records
+    Copying a cache (with AssignmentCache(cache)) only copies the mapping, since the records can be shared.
+    """
+
+    @classmethod
+    def from_db(cls, value: Any) -> "AssignmentCache":
+        """
+        Creates a cache from the assignments stored in the database (Anything which isn't an assignment is skipped)
+
+        Args:
+            value: The stored assignments
+
+        Returns:
+            The cache
+        """
+        if not isinstance(value, dict):
+            return cls()
+        return cls((assignment_id, record) for assignment_id, assignment in value.items()
+                   if (record := AssignmentRecord.from_db(assignment)) is not None)
+
+    def to_db(self) -> dict[str, dict[str, Any]]:
+        """
+        Converts the cache to the form it is stored in the database
+
+        Returns:
+            The assignments as dictionaries
+        """
+        return {assignment_id: assignment.to_db() for assignment_id, assignment in self.items()}
+
+    def get_db_delta(self, path: str, stored: "AssignmentCache") -> dict[str, Any]:
+        """
+        Computes the smallest multi-path update which changes the cache stored at a path in the database to this one
+        (see get_db_delta). Only the records which have changed are compared field by field.
+
+        Args:
+            path: The path of the cache
+            stored: The cache currently stored at the path
+
+        Returns:
+            A dictionary mapping each path which needs to change to its new value (or None if it should be deleted)
+        """
+        delta = {}
+        for assignment_id in self.keys() | stored.keys():
+            old, new = stored.get(assignment_id, None), self.get(assignment_id, None)
+            if old != new:
+                delta.update(get_db_delta(f'{path}/{assignment_id}', old and old.to_db(), new and new.to_db()))
+        return delta
+
+
 def due_date_from_progress_div(progress_div: etree.Element) -> str:
     """
     Parses a Gradescope progress div and returns the due date
@@ -459,41 +1842,89 @@ def due_date_from_progress_div(progress_div: etree.Element) -> str:
     Returns:
         The due date of the assignment
     """
-    # HTML parsing nonsense
-    times = progress_div.findall("./time")
-    return datetime.strptime(times[1].get("datetime"), GRADESCOPE_DATETIME_FORMAT).isoformat()
+    due_date = ASSIGNMENT_DUE_DATE_QUERY(progress_div)[0]
+    # Reformat the date directly if it's in the usual format, since strptime is slow
+    if match := GRADESCOPE_DATETIME_PATTERN.fullmatch(due_date):
+        return "{}T{}{}:{}".format(*match.groups())
+    return datetime.strptime(due_date, GRADESCOPE_DATETIME_FORMAT).isoformat()
+
+
+def get_next_due_date(assignments: AssignmentList) -> Optional[datetime]:
+    """
+    Finds the earliest due date which hasn't passed yet out of a user's incomplete assignments
 
+    Args:
+        assignments: The user's assignment cache
 
-async def enumerate_gradescope_assignments(course_settings: CourseList, gradescope_token: str) -> AssignmentList:
+    Returns:
+        The next due date, or None if the user has no upcoming assignments
+    """
+    now = datetime.now(timezone.utc)
+    due_dates = []
+    for assignment in assignments.values():
+        if assignment.completed or (due_date := assignment.get_due_datetime()) is None:
+            continue
+        if due_date > now:
+            due_dates.append(due_date)
+    return min(due_dates, default=None)
+
+
+async def enumerate_gradescope_assignments(course_settings: CourseList, gradescope_token: str,
+                                           connector: Optional[aiohttp.BaseConnector] = None,
+                                           course_fingerprints: Optional[dict[str, str]] = None,
+                                           parse_executor: Optional[concurrent.futures.Executor] = None) \
+        -> tuple[AssignmentList, dict[str, str]]:
     """
     Downloads the Gradescope assignments for a user's courses and returns them in a dictionary
 
     Args:
         course_settings: The user's course settings
         gradescope_token: The user's Gradescope token
+        connector: A shared connection pool to make the requests through (see create_gradescope_connector). If this is
+                   None, a new pool is created (and closed) for this user.
+        course_fingerprints: The fingerprints of the course pages from the last time they were parsed (see
+                             fingerprint_course_page). Courses whose pages still have the same fingerprint are skipped.
+        parse_executor: The executor to parse the course pages in (see get_parse_executor). If this is None, the pages
+                        are parsed on the event loop.
 
     Returns:
-        The user's Gradescope assignments in a dictionary, mapping assignment IDs to assignments
+        The user's Gradescope assignments in a dictionary, mapping assignment IDs to assignments (not including the
+        assignments of skipped courses), and the new fingerprint of each course's page
 
     Raises:
+        GradescopeAuthError: If Gradescope rejects the token
         RuntimeError: If a request fails
     """
+    course_fingerprints = course_fingerprints or {}
+
     # Create a single session to use for all the requests
+    # Each user gets their own session (and cookie jar), so cookies are never shared between users, even if the
+    # underlying connections are
+    # (Only the time spent waiting on Gradescope is limited, not the time spent waiting for a connection from the pool)
     gradescope_cookies = {"signed_token": gradescope_token}
-    async with aiohttp.ClientSession(cookies=gradescope_cookies, cookie_jar=CookieJar(quote_cookie=False)) as session:
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=GRADESCOPE_CONNECT_TIMEOUT,
+                                    sock_read=GRADESCOPE_READ_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, connector_owner=connector is None, timeout=timeout,
+                                     cookies=gradescope_cookies, cookie_jar=CookieJar(quote_cookie=False)) as session:
         # Fetch the assignments for each course asynchronously
-        tasks = [fetch_course_assignments(course_id, course, session) for course_id, course in
-                 course_settings.items()]
-        assignments = await asyncio.gather(*tasks)
+        tasks = [fetch_course_assignments(course_id, course, session, course_fingerprints.get(course_id, None),
+                                          parse_executor)
+                 for course_id, course in course_settings.items()]
+        results = await asyncio.gather(*tasks)
 
     # Flatten the list of assignments into a single dictionary
-    assignments = {assignment_id: assignment for course_assignments in assignments for assignment_id, assignment in
-                   course_assignments.items()}
+    assignments = {assignment_id: assignment for course_assignments, _fingerprint in results if course_assignments
+                   for assignment_id, assignment in course_assignments.items()}
+    new_course_fingerprints = {course_id: fingerprint for course_id, (_assignments, fingerprint) in
+                               zip(course_settings.keys(), results)}
 
-    return assignments
+    return assignments, new_course_fingerprints
 
 
-async def fetch_course_assignments(course_id: str, course: Course, session: aiohttp.ClientSession) -> AssignmentList:
+async def fetch_course_assignments(course_id: str, course: Course, session: aiohttp.ClientSession,
+                                   fingerprint: Optional[str] = None,
+                                   parse_executor: Optional[concurrent.futures.Executor] = None) \
+        -> tuple[AssignmentList | None, str]:
     """
     Downloads the Gradescope assignments for a single course and returns them in a dictionary
 
@@ -501,31 +1932,163 @@ async def fetch_course_assignments(course_id: str, course: Course, session: aioh
         course_id: The ID of the course
         course: The course to download the assignments for
         session: The aiohttp session to use to download the assignments (must be authenticated with Gradescope)
+        fingerprint: The fingerprint of the course page from the last time it was parsed (if known)
+        parse_executor: The executor to parse the course page in (or None to parse it on the event loop)
 
     Returns:
-        The course's assignments in a dictionary, mapping assignment IDs to assignments
+        The course's assignments in a dictionary, mapping assignment IDs to assignments (or None if the page's
+        fingerprint hasn't changed, so the assignments are the same as last time), and the page's fingerprint
 
     Raises:
+        GradescopeAuthError: If Gradescope rejects the session's token
         RuntimeError: If the request fails
     """
-    assignments = {
-        # The assignment ID is the Gradescope assignment ID prefixed with the course ID
-        f'{course_id}-{get_assignment_id(assignment)}': parse_assignment(assignment, course_id)
-        for assignment in
-        await get_async_data_from_gradescope(course["href"], ".//table[@id='assignments-student-table']/tbody/tr",
-                                             session)
-        # If the assignment is past due or does not have a due date, Gradescope will not include a progress bar div
-        if len(assignment[2]) >= 1 and len(assignment[2][0]) > 1
-    }
-    # Filter out assignments that don't have a due date or were parsed incorrectly
-    assignments = {
-        assignment_id: assignment for assignment_id, assignment in assignments.items() if
-        isinstance(assignment, dict) and assignment["due_date"] and not assignment_id.endswith("-Unknown")
-    }
+    # Only download as much of the page as is needed for the assignments table
+    page = await get_async_page_from_gradescope(course["href"], session, COURSE_PAGE_ASSIGNMENTS_SECTION)
+
+    # If the assignments table hasn't changed, there's no need to parse it
+    if (page_fingerprint := fingerprint_course_page(page)) == fingerprint:
+        stats["course_pages_unchanged"] += 1
+        return None, page_fingerprint
+    stats["course_pages_parsed"] += 1
+
+    if parse_executor is None:
+        return parse_course_assignments(page, course_id), page_fingerprint
+
+    try:
+        assignments = await asyncio.get_running_loop().run_in_executor(parse_executor, parse_course_assignments,
+                                                                       page, course_id)
+    except concurrent.futures.BrokenExecutor:
+        # A worker died (e.g. it ran out of memory), so replace the pool for later pages and parse this one here
+        discard_parse_executor(parse_executor)
+        stats["course_page_parse_executor_failures"] += 1
+        assignments = parse_course_assignments(page, course_id)
+    return assignments, page_fingerprint
+
+
+def get_parse_executor(kind: Optional[str], max_workers: Optional[int] = None) \
+        -> Optional[concurrent.futures.Executor]:
+    """
+    Gets an executor to parse course pages in (see parse_course_assignments), so that parsing doesn't hold up the other
+    users on the event loop
+    Executors are kept between invocations, so that their workers are already running when the next batch starts.
+
+    Args:
+        kind: "thread" for a thread pool (lxml releases the GIL while it parses), "process" for a process pool, or None
+              to parse on the event loop
+        max_workers: The number of workers in the pool (defaults to the number of CPUs)
+
+    Returns:
+        The executor, or None if kind is None
+
+    Raises:
+        ValueError: If kind is not a known kind of executor
+    """
+    if kind is None:
+        return None
+    max_workers = max_workers or multiprocessing.cpu_count()
+    if (executor := _parse_executors.get((kind, max_workers), None)) is not None:
+        return executor
+
+    if kind == "thread":
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="parse")
+    elif kind == "process":
+        # Workers are forked from a clean server process rather than from this one, since this process has other
+        # threads (whose locks could be copied into the workers while held)
+        # The server only imports this module, rather than the main script, so the workers start up quickly
+        mp_context = multiprocessing.get_context("forkserver")
+        mp_context.set_forkserver_preload([__name__])
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+        # Start the workers now (each has to import this module before it can parse anything), without waiting for them
+        for _ in range(max_workers):
+            executor.submit(parse_course_assignments, b"", "")
+    else:
+        raise ValueError(f"Unknown parse executor kind: {kind}")
+
+    _parse_executors[(kind, max_workers)] = executor
+    return executor
+
+
+def discard_parse_executor(executor: concurrent.futures.Executor) -> None:
+    """
+    Shuts down a parse executor and removes it from the cache, so that get_parse_executor creates a new one
+
+    Args:
+        executor: The executor to discard
+    """
+    for key, cached_executor in list(_parse_executors.items()):
+        if cached_executor is executor:
+            del _parse_executors[key]
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_course_assignments(assignments_table: bytes, course_id: str) -> AssignmentList:
+    """
+    Parses the assignments table from a Gradescope course page
+    The table is parsed incrementally, and each row is discarded once it has been parsed, so that the whole table is
+    never held in memory as a tree. (Its bytes are, since the table's fingerprint has to be checked before it is parsed,
+    see fetch_course_assignments.)
+
+    Args:
+        assignments_table: The assignments table (see COURSE_PAGE_ASSIGNMENTS_SECTION)
+        course_id: The ID of the course
+
+    Returns:
+        The course's assignments in a dictionary, mapping assignment IDs to assignments (which is empty if the page
+        doesn't have an assignments table)
+    """
+    assignments = {}
+    if not assignments_table:
+        return assignments
+    parser = etree.HTMLPullParser(events=("end",), tag="tr")
+
+    def parse_rows() -> None:
+        for _event, row in parser.read_events():
+            # Only rows in the table's body are assignments (not the header row)
+            if row.getparent() is not None and row.getparent().tag == "tbody" and ASSIGNMENT_PROGRESS_QUERY(row):
+                assignment = parse_assignment(row, course_id)
+                # The assignment ID is the Gradescope assignment ID prefixed with the course ID
+                assignment_id = f'{course_id}-{get_assignment_id(row)}'
+                # Filter out assignments that don't have a due date or were parsed incorrectly
+                if assignment is not None and assignment.due_date and not assignment_id.endswith("-Unknown"):
+                    assignments[assignment_id] = assignment
+
+            # Free the row (and any rows before it) now that it has been parsed
+            row.clear()
+            while row.getprevious() is not None:
+                del row.getparent()[0]
+
+    for i in range(0, len(assignments_table), COURSE_PAGE_PARSE_CHUNK_SIZE):
+        parser.feed(assignments_table[i:i + COURSE_PAGE_PARSE_CHUNK_SIZE])
+        parse_rows()
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        # The table didn't contain any elements (The rows which were parsed are still returned)
+        pass
+    parse_rows()
 
     return assignments
 
 
+def fingerprint_course_page(page: bytes) -> str:
+    """
+    Computes a fingerprint of the assignments table on a Gradescope course page
+    (The rest of the page is ignored because it contains things like CSRF tokens which change on every request)
+
+    Args:
+        page: The contents of the course page
+
+    Returns:
+        The fingerprint of the page
+    """
+    # Find the assignments table without parsing the page
+    if (table_start := page.find(b'id="assignments-student-table"')) != -1:
+        table_end = page.find(b'</table>', table_start)
+        page = page[table_start:table_end if table_end != -1 else len(page)]
+    return hashlib.blake2b(page, digest_size=16).hexdigest()
+
+
 def get_assignment_id(assignment: etree.Element) -> str:
     """
     Gets the Gradescope assignment ID from an assignment element
@@ -536,8 +2099,9 @@ def get_assignment_id(assignment: etree.Element) -> str:
     Returns:
         The Gradescope assignment ID or "Unknown" if the ID could not be found
     """
-    # HTML parsing nonsense
-    assignment = assignment[0][0]
+    if not (link := ASSIGNMENT_LINK_QUERY(assignment)):
+        return "Unknown"
+    assignment = link[0]
     # Gradescope will sometimes use a button and sometimes use a link to the assignment page
     if assignment.tag == "button":
         # If it's a button, the ID is in the data-assignment-id attribute
@@ -562,51 +2126,51 @@ def get_assignment_name(assignment: etree.Element) -> str:
     Returns:
         The name of the assignment or "<Unknown Assignment>" if the name could not be found
     """
-    # HTML parsing nonsense
-    assignment_name = assignment.find("./th")
-    return transform_or_default(assignment_name[0] if len(assignment_name) > 0 else assignment_name,
-                                lambda name: name.text, "<Unknown Assignment>").strip()
+    # The name is either directly in the cell, or in the button or link inside it
+    if not (assignment_name := ASSIGNMENT_NAME_QUERY(assignment)):
+        return "<Unknown Assignment>"
+    assignment_name = assignment_name[0][0] if len(assignment_name[0]) > 0 else assignment_name[0]
+    return (assignment_name.text or "").strip()
 
 
-def parse_assignment(assignment: etree.Element, course_id: str) -> Assignment | None:
+def parse_assignment(assignment: etree.Element, course_id: str) -> Optional[AssignmentRecord]:
     """
-    Parses an assignment element and returns the assignment information in a dictionary
+    Parses an assignment element and returns the assignment information as a record
 
     Args:
         assignment: The assignment element to parse
         course_id: The ID of the course the assignment is for
 
     Returns:
-        The assignment information in a dictionary, or None if the assignment could not be parsed
+        The assignment information (without an event), or None if the assignment could not be parsed
     """
     try:
-        return {
-            "name": get_assignment_name(assignment),
-            "due_date": due_date_from_progress_div(assignment[2][0][2]),
-            "completed": len(assignment[1]) != 2 or assignment[1][1].text == "Submitted",
-            "course_id": course_id,
-            # The event is not outdated if the assignment has not yet been added to the cache
-            "outdated": False
-        }
+        status = ASSIGNMENT_STATUS_QUERY(assignment)
+        return AssignmentRecord(
+            name=get_assignment_name(assignment),
+            due_date=due_date_from_progress_div(ASSIGNMENT_PROGRESS_QUERY(assignment)[0]),
+            completed=len(status) != 2 or status[1].text == "Submitted",
+            course_id=course_id
+        )
     except Exception as e:
         print(e)
         return None
 
 
-def update_gradescope_assignment(assignment: Assignment, old_assignment: Assignment | None) -> Assignment:
+def update_gradescope_assignment(assignment: AssignmentRecord, old_assignment: Optional[AssignmentRecord]) \
+        -> AssignmentRecord:
     """
     Updates an assignment in the user's assignment cache with new information from Gradescope
     """
     if not old_assignment:
         # If the assignment is new, it has no event ID and is not associated with an outdated event
-        assignment["event_id"] = ""
-        assignment["outdated"] = False
-    else:
-        # Otherwise, the assignment has the same event ID and the event is outdated if something has changed
-        assignment["event_id"] = old_assignment["event_id"]
-        assignment["outdated"] = (old_assignment["outdated"] or assignment["due_date"] != old_assignment["due_date"]
-                                  or assignment["name"] != old_assignment["name"])
-    return assignment
+        return assignment
+
+    # Otherwise, the assignment has the same event (and event hash) and the event is outdated if something has changed
+    outdated = (old_assignment.outdated or assignment.due_date != old_assignment.due_date
+                or assignment.name != old_assignment.name)
+    return dataclasses.replace(assignment, event_id=old_assignment.event_id, outdated=outdated,
+                               event_hash=old_assignment.event_hash)
 
 
 # endregion
@@ -640,26 +2204,170 @@ def validate_calendar_id(calendar_id: str, calendar_service: Any) -> bool:
     return calendar and not calendar.get("deleted", False) and calendar["accessRole"] in ("owner", "writer")
 
 
-def get_user_settings(uid: str) -> UserSettings | None:
+def validate_calendar_id_with_cache(user: "UserContext", calendar_id: str, calendar_service: Any, ttl: float) -> bool:
     """
-    Gets and validates a user's settings from the database
+    Checks if a calendar ID is valid and accessible by the user, reusing the result of a previous successful check if it
+    is less than ttl seconds old
 
     Args:
-        uid: The user's UID
+        user: The user's data
+        calendar_id: The calendar ID to check
+        calendar_service: The Google Calendar service
+        ttl: The number of seconds for which a successful check is trusted
+
+    Returns:
+        True if the calendar ID is valid and the user has write access to the calendar, False otherwise
+    """
+    # Was this calendar recently found to be valid?
+    cached_validation = user.cache.get("calendar_validation", None)
+    if (cached_validation and cached_validation.get("calendar_id", None) == calendar_id and
+            time.time() - cached_validation.get("validated_at", 0) < ttl):
+        return True
+
+    # If not, check it
+    if valid := validate_calendar_id(calendar_id, calendar_service):
+        user.cache["calendar_validation"] = {"calendar_id": calendar_id, "validated_at": time.time()}
+        user.write({f'cache/{user.uid}/calendar_validation': user.cache["calendar_validation"]})
+    elif cached_validation:
+        invalidate_calendar_validation(user)
+
+    return valid
+
+
+def invalidate_calendar_validation(user: "UserContext") -> None:
+    """
+    Forgets that a user's calendar was found to be valid, so that it is checked again the next time it is used
+
+    Args:
+        user: The user's data
+
+    Returns:
+        None
+    """
+    user.cache.pop("calendar_validation", None)
+    user.write({f'cache/{user.uid}/calendar_validation': None})
+
+
+def is_calendar_access_error(exception: Exception | None) -> bool:
+    """
+    Checks if an exception from the Google Calendar API indicates that the calendar may no longer exist or may no longer
+    be writable by the user
+    """
+    return (isinstance(exception, HttpError) and exception.status_code in (403, 404) and
+            not is_rate_limit_error(exception))
+
+
+def get_user_settings(user: "UserContext") -> UserSettings | None:
+    """
+    Gets and validates a user's settings
+
+    Args:
+        user: The user's data
 
     Returns:
         The user's settings, or None if the settings could not be retrieved or are invalid
     """
-    # Get the user's settings from the database
-    user_settings = get_db_ref_as_type(f'settings/{uid}', UserSettings)
     # Validate the user's settings
-    if validate_object_with_keys(user_settings, "calendar_id", "courses", "completed_assignment_color"):
+    if validate_object_with_keys(user.settings, "calendar_id", "courses", "completed_assignment_color"):
         # If the settings are valid, return them
-        return user_settings
+        return user.settings
     # Otherwise, return None
     return None
 
 
+class SyncLeaseHeldError(Exception):
+    """
+    Raised inside a transaction on a user's sync lease to abort it, because the lease is held by someone else
+    """
+    pass
+
+
+def acquire_sync_lease(uid: str, duration: float) -> tuple[Optional[str], int]:
+    """
+    Tries to take a user's sync lease, which stops their assignments and calendar from being updated by two functions
+    at once. The lease expires after duration seconds, in case its holder never releases it.
+    Each time a lease is released after a sync, the lease's generation is increased, so that other functions can tell
+    that the user has been synced since they last looked.
+
+    Args:
+        uid: The user's UID
+        duration: The number of seconds to hold the lease for
+
+    Returns:
+        The ID of the lease (or None if someone else holds it), and the lease's generation
+    """
+    lease_id = uuid.uuid4().hex
+    generation = 0
+
+    def take_lease(lease: Any) -> dict[str, Any]:
+        nonlocal generation
+        lease = lease if isinstance(lease, dict) else {}
+        generation = lease.get("generation", 0)
+        if lease.get("holder", None) and lease.get("expires_at", 0) > time.time():
+            raise SyncLeaseHeldError()
+        return {"holder": lease_id, "expires_at": time.time() + duration, "generation": generation}
+
+    try:
+        db.reference(f'sync_state/{uid}/lease').transaction(take_lease)
+    except SyncLeaseHeldError:
+        return None, generation
+    return lease_id, generation
+
+
+def release_sync_lease(uid: str, lease_id: str, synced: bool = True) -> None:
+    """
+    Releases a user's sync lease (see acquire_sync_lease), if it is still held by the given lease ID
+
+    Args:
+        uid: The user's UID
+        lease_id: The ID of the lease
+        synced: Whether the user was synced while the lease was held (if so, the lease's generation is increased)
+
+    (If the lease can't be released, the error is reported rather than raised, and the lease is left to expire)
+    """
+
+    def drop_lease(lease: Any) -> dict[str, Any]:
+        if not isinstance(lease, dict) or lease.get("holder", None) != lease_id:
+            raise SyncLeaseHeldError()
+        return {"generation": lease.get("generation", 0) + (1 if synced else 0)}
+
+    try:
+        db.reference(f'sync_state/{uid}/lease').transaction(drop_lease)
+    except SyncLeaseHeldError:
+        # The lease expired and was taken by someone else
+        pass
+    except Exception as e:
+        # Releasing the lease is only an optimization, so failing to must not fail the sync
+        print(f"Failed to release the sync lease of {uid}")
+        report_exception(e)
+
+
+async def wait_for_sync_lease(uid: str, generation: int, timeout: float, poll_interval: float = 1) -> bool:
+    """
+    Waits for the sync which holds a user's sync lease to finish
+
+    Args:
+        uid: The user's UID
+        generation: The lease's generation when it was found to be held
+        timeout: The maximum number of seconds to wait
+        poll_interval: The number of seconds between checks of the lease
+
+    Returns:
+        True if the user was synced (the lease was released with a newer generation), False if the lease expired
+        without being released or the timeout was reached
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(poll_interval)
+        lease = await run_blocking(db.reference(f'sync_state/{uid}/lease').get)
+        lease = lease if isinstance(lease, dict) else {}
+        if lease.get("generation", 0) > generation:
+            return True
+        if not lease.get("holder", None) or lease.get("expires_at", 0) <= time.time():
+            return False
+    return False
+
+
 # endregion
 
 # region Util
@@ -704,6 +2412,65 @@ def sync(func: Callable) -> Callable:
     return wrapper
 
 
+async def run_blocking(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Runs a blocking function in the event loop's default executor so that it doesn't block other coroutines
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def gather_until_deadline(limit: int, items: list[T], func: Callable[[T], Awaitable[Any]],
+                                start_deadline: float, finish_deadline: float) -> list[T]:
+    """
+    Runs func on each item concurrently (never running more than limit of them at the same time), while keeping to a
+    time budget. No new items are started after start_deadline, and any items which are still running at
+    finish_deadline are cancelled. (Both deadlines are in terms of time.monotonic)
+
+    Returns:
+        The items which were not started or did not finish in time
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run_with_deadline(item: T) -> bool:
+        async with semaphore:
+            if time.monotonic() >= start_deadline:
+                return False
+            try:
+                await asyncio.wait_for(func(item), timeout=max(finish_deadline - time.monotonic(), 0))
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+    finished = await asyncio.gather(*(run_with_deadline(item) for item in items))
+    return [item for item, item_finished in zip(items, finished) if not item_finished]
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """
+    Returns the value below which the given fraction of values fall (using the nearest-rank method)
+    """
+    values = sorted(values)
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def pack_batches(items: Iterable[tuple[T, float]], budget: float, max_size: int) -> Iterator[list[T]]:
+    """
+    Splits items (given with their costs) into batches, in order, so that the total cost of each batch is at most budget
+    and no batch has more than max_size items (An item which costs more than the budget on its own is put in a batch by
+    itself)
+    Each batch is yielded as soon as it is full, so items can be streamed in.
+    """
+    batch, batch_cost = [], 0
+    for item, cost in items:
+        if batch and (batch_cost + cost > budget or len(batch) >= max_size):
+            yield batch
+            batch, batch_cost = [], 0
+        batch.append(item)
+        batch_cost += cost
+    if batch:
+        yield batch
+
+
 def transform_or_default(data: T | None, transform: Callable[[T], U], default: U) -> U:
     """
     Transforms data with transform if it is not None, otherwise returns a default value
@@ -719,23 +2486,16 @@ def validate_object_with_keys(obj: Any, *keys: str) -> bool:
     return obj and all(key in obj for key in keys)
 
 
-def wrap_async_exceptions(func: Callable) -> Callable:
+def report_exception(exception: Exception) -> None:
     """
-    Wraps an async function so that any exceptions are silenced and reported to Google Cloud Error Reporting
+    Prints an exception and reports it to Google Cloud Error Reporting (This must be called from the except block which
+    caught the exception)
     """
-
-    @functools.wraps(func)
-    async def wrapper(*args, **kwargs):
-        try:
-            return await func(*args, **kwargs)
-        except Exception as e:
-            try:
-                print(e)
-                from google.cloud import error_reporting
-                error_reporting.Client().report_exception()
-            except Exception as e2:
-                print(e2)
-
-    return wrapper
+    try:
+        print(exception)
+        from google.cloud import error_reporting
+        error_reporting.Client().report_exception()
+    except Exception as e:
+        print(e)
 
 # endregion
@@ -8,7 +8,9 @@ export const onUserDelete = auth.user().onDelete((user) => {
     return getDatabase().ref("/").update({
         [`assignments/${user.uid}`]: null,
         [`auth_status/${user.uid}`]: null,
+        [`cache/${user.uid}`]: null,
         [`credentials/${user.uid}`]: null,
         [`settings/${user.uid}`]: null,
+        [`sync_state/${user.uid}`]: null,
     });
 });
@@ -203,6 +203,8 @@ function refreshCourseList() {
     .catch(error => {
         if (error.message === "invalid_gradescope_auth") {
             alert("Error: Invalid Gradescope credentials! Try relinking your Gradescope account.");
+        } else if (error.message === "gradescope_unavailable") {
+            alert("Gradescope is currently unavailable. Please try again later.");
         } else {
             dashboardErrorHandler(error, "An error occurred refreshing your course list.");
         }
@@ -232,6 +234,12 @@ function refreshEvents() {
             case "invalid_user_settings":
                 alert("Error: Invalid user settings!");
                 break;
+            case "sync_in_progress":
+                alert("Your events are already being updated. Please try again in a few minutes.");
+                break;
+            case "service_unavailable":
+                alert("Gradescope or Google Calendar is currently unavailable. Please try again later.");
+                break;
             default:
                 dashboardErrorHandler(error, "An error occurred reloading your events.");
                 break;
@@ -56,6 +56,8 @@ function validateGradescopeCredentials() {
         }).catch(error => {
             if(error.message === "invalid_gradescope_auth") {
                 alert("Invalid Token!");
+            } else if(error.message === "gradescope_unavailable") {
+                alert("Gradescope is currently unavailable. Please try again later.");
             } else {
                 gradescopeLinkerErrorHandler(error, "An error occurred while validating your token!");
             }
@@ -87,6 +89,8 @@ function validateGradescopeCredentials() {
         }).catch(error => {
             if(error.message === "invalid_gradescope_auth") {
                 alert("Invalid Credentials!");
+            } else if(error.message === "gradescope_unavailable") {
+                alert("Gradescope is currently unavailable. Please try again later.");
             } else {
                 gradescopeLinkerErrorHandler(error, "An error occurred while validating your token!");
             }